@@ -0,0 +1,271 @@
+"""Non-blocking valve actuation with crash-safe shutoff
+
+Valve.on(duration) sleeps in the caller until it turns the valve off, and the
+only record that the valve should close is in that sleeping process. If the
+process dies, the valve stays open.
+
+The Actuator instead turns valves on immediately and returns. A dedicated
+timer thread keeps a heap of off-deadlines on the monotonic clock (which
+never jumps, unlike the wall clock) and turns each valve off when its deadline
+comes. Every valve is always given a deadline, at most max_duration away.
+
+Open deadlines are also saved to a file as wall-clock times. When a valve is
+registered after a restart, it is always closed, and a saved deadline is
+reported as an interrupted run (and counted in valve_interrupted_runs_total).
+The run is never resumed: without a real-time clock, the wall clock may be
+wrong after a reboot, so the saved deadline can't be trusted.
+
+Only one process at a time can own the file (and so the valves): a second
+Actuator on the same file raises RuntimeError. Processes which share a valve
+should use the hardware broker (hardware.py).
+
+If turning a valve off fails (e.g. a GPIO or broker error), the failure is
+counted in errors_total and retried every few seconds. The deadline stays
+saved until the valve has closed.
+
+The delay between each deadline and the valve actually turning off is
+observed in the valve_off_latency_seconds histogram.
+valve_timer_drift_seconds is the difference between the wall-clock and
+monotonic time that elapsed, which shows clock adjustments during a watering.
+
+Usage:
+    valve = actuated_valve("valve_deadlines.json")
+    valve.on(600)      # returns at once, closes in 10 minutes
+    valve.timer(600)   # the same, but waits until the valve has closed
+"""
+
+import fcntl
+import heapq
+import json
+import os
+import threading
+import time
+from datetime import datetime
+from time import monotonic
+
+import metrics
+
+
+class Actuator:
+    """Turns registered valves off at their deadlines from a timer thread
+
+    file:          Where open deadlines are saved
+    max_duration:  Longest time in seconds a valve may stay open
+    debug:         Outputs debugging messages
+    retry:         Seconds between attempts to turn off a valve which failed
+                   to turn off at its deadline
+    """
+
+    def __init__(self, file="valve_deadlines.json", max_duration=60*60, debug=False, retry=5):
+        self.file = file
+        self.max_duration = max_duration
+        self.debug = debug
+        self.retry = retry
+
+        self.valves = {}
+        self.deadlines = {}  # name -> (monotonic deadline, wall-clock deadline)
+        self.closed = {}     # name -> Event, set while the valve is closed
+        self.heap = []       # (monotonic deadline, name), possibly stale
+        self.condition = threading.Condition()
+
+        # held for the life of the process, so no other process saves over
+        # these deadlines
+        self.lock = open(file + ".lock", 'w')
+        try:
+            fcntl.flock(self.lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self.lock.close()
+            raise RuntimeError(f"{file} is used by another process; share the "
+                               "valve through the hardware broker (HARDWARE_SOCKET)")
+
+        # deadlines saved by an earlier run, until their valves are registered
+        try:
+            with open(file) as f:
+                self.saved = json.load(f)
+        except (OSError, ValueError):
+            self.saved = {}
+
+        self.thread = threading.Thread(target=self.run, name="actuator", daemon=True)
+        self.thread.start()
+
+
+    def register(self, name, valve):
+        """Control valve as name, returning an ActuatedValve
+
+        The valve is always closed. A saved deadline means an earlier run
+        was interrupted while the valve was open; it is reported, not resumed.
+        """
+        with self.condition:
+            self.valves[name] = valve
+            self.closed[name] = threading.Event()
+            deadline = self.saved.pop(name, None)
+        self.close(name)
+
+        if deadline is not None:
+            print(f"{datetime.now()} | Closed {name}, left open by an interrupted run "
+                  f"(it was due to close at {datetime.fromtimestamp(deadline)})")
+            metrics.increment("valve_interrupted_runs_total", valve=name)
+        return ActuatedValve(self, name)
+
+
+    def open(self, name, duration=None):
+        """Turn valve name on for duration seconds (default max_duration)
+
+        Returns immediately with the duration applied, which is at most
+        max_duration. Opening a valve which is already open replaces its
+        deadline.
+        """
+        if duration is not None and not duration >= 0:
+            raise ValueError(f"duration must be at least 0 seconds, not {duration}")
+        duration = self.max_duration if duration is None else min(duration, self.max_duration)
+        with self.condition:
+            self.valves[name].on()
+            deadline = monotonic() + duration
+            wall = time.time() + duration
+            self.deadlines[name] = (deadline, wall)
+            heapq.heappush(self.heap, (deadline, name))
+            self.closed[name].clear()
+            self.save()
+            self.condition.notify()
+        return duration
+
+
+    def close(self, name):
+        """Turn valve name off now"""
+        with self.condition:
+            self.valves[name].off()
+            self.deadlines.pop(name, None)
+            self.closed[name].set()
+            self.save()
+            self.condition.notify()
+
+
+    def remaining(self, name):
+        """Seconds until valve name closes, 0 if it is closed"""
+        with self.condition:
+            if name not in self.deadlines:
+                return 0
+            return max(0.0, self.deadlines[name][0] - monotonic())
+
+
+    def wait(self, name, timeout=None):
+        """Wait until valve name is closed. Returns False on timeout."""
+        return self.closed[name].wait(timeout)
+
+
+    def run(self):
+        with self.condition:
+            while True:
+                # skip entries replaced by a later open() or removed by close()
+                while self.heap and self.deadlines.get(self.heap[0][1], (None,))[0] != self.heap[0][0]:
+                    heapq.heappop(self.heap)
+
+                if not self.heap:
+                    self.condition.wait()
+                    continue
+
+                deadline, name = self.heap[0]
+                if monotonic() < deadline:
+                    self.condition.wait(deadline - monotonic())
+                    continue
+
+                heapq.heappop(self.heap)
+                _, wall = self.deadlines[name]
+                try:
+                    self.valves[name].off()
+                except Exception as e:
+                    # keep the deadline (and its saved wall-clock time, for a
+                    # restart) and try again, rather than let the thread die
+                    print(f"{datetime.now()} | Failed to close {name}, retrying in {self.retry}s: {e!r}")
+                    metrics.increment("errors_total", source="valve_off", valve=name)
+                    self.deadlines[name] = (monotonic() + self.retry, wall)
+                    heapq.heappush(self.heap, (self.deadlines[name][0], name))
+                    continue
+                del self.deadlines[name]
+                latency = monotonic() - deadline
+                metrics.observe("valve_off_latency_seconds", latency, valve=name)
+                metrics.set_gauge("valve_timer_drift_seconds",
+                                  (time.time() - wall) - latency, valve=name)
+                self.closed[name].set()
+                try:
+                    self.save()
+                except OSError as e:
+                    print(f"{datetime.now()} | Failed to save {self.file}: {e!r}")
+                    metrics.increment("errors_total", source="valve_deadlines")
+                if self.debug: print(f"{datetime.now()} | Closed {name} {latency*1000:.1f}ms after its deadline")
+
+
+    def save(self):
+        """Write the open deadlines, and those of valves not registered yet"""
+        deadlines = {**self.saved, **{name: wall for name, (_, wall) in self.deadlines.items()}}
+        with open(self.file + ".tmp", 'w') as f:
+            json.dump(deadlines, f)
+        os.replace(self.file + ".tmp", self.file)
+
+
+class ActuatedValve:
+    """A valve of an Actuator, with the same methods as Valve
+
+    on() returns immediately; timer() waits until the valve has closed. Both
+    return the duration applied, which is at most the Actuator's max_duration.
+    """
+
+    def __init__(self, actuator, name):
+        self.actuator = actuator
+        self.name = name
+
+
+    def on(self, duration=None):
+        """Turn the valve on for duration seconds (default the longest allowed)"""
+        return self.actuator.open(self.name, duration)
+
+
+    def off(self):
+        self.actuator.close(self.name)
+
+
+    def timer(self, duration):
+        """Water for duration seconds and return when the valve has closed"""
+        duration = self.on(duration)
+        self.actuator.wait(self.name)
+        return duration
+
+
+    def status(self):
+        return self.actuator.valves[self.name].status()
+
+
+    def remaining(self):
+        return self.actuator.remaining(self.name)
+
+
+def actuated_valve(file="valve_deadlines.json", max_duration=60*60, debug=False, **valve_args):
+    """Create a Valve controlled by its own Actuator, as an ActuatedValve"""
+    from valve import Valve
+
+    return Actuator(file, max_duration, debug).register("valve", Valve(**valve_args))
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    file = os.path.join(tempfile.mkdtemp(), "deadlines.json")
+    valve = actuated_valve(file, max_duration=1, debug=True)
+    valve.on(0.5)
+    print(f"returned at once, {valve.remaining():.2f}s left, saved {open(file).read()}")
+    print(f"timer(5) capped at {valve.timer(5)}s, valve on: {valve.status()}")
+
+    try:
+        Actuator(file)
+    except RuntimeError as e:
+        print(e)
+
+    # a deadline left behind by a process which died while watering
+    file = os.path.join(os.path.dirname(file), "interrupted.json")
+    with open(file, 'w') as f:
+        json.dump({"valve": time.time() + 600}, f)
+    valve.actuator.valves["valve"].on()
+    start = monotonic()
+    valve = Actuator(file, debug=True).register("valve", valve.actuator.valves["valve"])
+    print(f"valve closed {(monotonic() - start)*1000:.1f}ms after start-up, on: {valve.status()}")
+    print(metrics.render())
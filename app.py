@@ -25,55 +25,341 @@ USER_AGENT="YourName YourEmail"
 LATITUDE=38.1234
 LONGITUDE=-77.1234
 
-"""
+(NWS_API_SERVER can point the weather client at another server, such as the
+stand-in server of the benchmarks.)
+
+Soil model parameters fitted by calibrate.py are loaded from SOIL_PARAMETERS
+(default soil_params.json) if that file exists.
+
+Each session's forecast comes from a plan of every session in the forecast,
+saved to PLAN_FILE (default plan.json) and kept until the NWS publishes a newer
+forecast (see planner.py). The NWS updates hourly, so sessions 12 hours apart
+usually replan from a new download; the plan mostly serves /api/plan.
+
+With FEEDBACK_TARGET (a sensor_value, e.g. 60), each session waters in pulses
+of PULSE_SECONDS (default 120) with soaks of SOAK_SECONDS (default 600) until
+the soil reaches the target, never for longer in total than the computed
+duration (see cycle_soak.py).
 
-from weather import NationalWeatherService
-from soil_moisture_sensor import SoilMoistureSensor
-import soil
-from irrigation_model import IrrigationModel
-from valve import Valve
-from log import Log
+With --daemon, the application stays resident and waters on a schedule, which
+can be set with (for example) SCHEDULE="06:00,18:00" in the same file. Missed
+sessions are caught up at start-up, like Persistent=true in the systemd timer;
+the time of the last attempt is kept in SCHEDULE_STATE (default
+last_session.txt).
+The soil moisture sensor is then sampled continuously (every SAMPLE_INTERVAL
+seconds, default 1) and sessions use the median of recent samples. With
+TELEMETRY_DIR set, every sample is also kept there (see telemetry.py).
+
+Start-up is kept short, since the timer starts a new process for every
+session: the weather client, hardware and log are imported and created in
+background threads, so the NWS lookup, the sensor's settling delay and the
+imports overlap. --profile-startup prints how long each step took.
+
+"""
 
+import argparse
+import importlib
+import threading
+import time
+import traceback
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
 from pprint import pprint
-import json
-from dotenv import dotenv_values
 
-config = dotenv_values(".env")
+from startup import Profile
+import metrics
+
+profile = Profile()
+
+
+class Garden:
+    """The objects used by every watering session
+
+    These are created once. In daemon mode they stay open between sessions,
+    so each session only pays for its own work.
+
+    Each object is created in a background thread (see start()) and becomes
+    an attribute as soon as it is first used, or when ready() is called.
+    """
+
+    def __init__(self, config, profile=profile):
+        self.profile = profile
+        self.pending = {}
+        self.pool = ThreadPoolExecutor(max_workers=6)
+
+        self.start("weather", "weather",
+                   lambda m: m.NationalWeatherService(
+                       latitude=config['LATITUDE'],
+                       longitude=config['LONGITUDE'],
+                       user_agent=config['USER_AGENT'],
+                       api_server=config.get('NWS_API_SERVER', "https://api.weather.gov")))
+        # With HARDWARE_SOCKET, the valve and sensor are owned by the hardware
+        # broker (hardware.py) and shared with the web interface
+        if config.get('HARDWARE_SOCKET'):
+            self.start("sensor", "hardware", lambda m: m.RemoteSensor(config['HARDWARE_SOCKET']))
+            self.start("valve", "hardware", lambda m: m.RemoteValve(config['HARDWARE_SOCKET']))
+        else:
+            self.start("sensor", "soil_moisture_sensor", lambda m: m.SoilMoistureSensor(debug=15000))
+            # the valve is turned off by the actuator's timer thread, which
+            # also closes it after a crash once the application restarts
+            self.start("valve", "actuator",
+                       lambda m: m.actuated_valve(config.get('VALVE_DEADLINES', 'valve_deadlines.json'),
+                                                  float(config.get('VALVE_MAX_DURATION', 60*60))))
+
+        # My system filled 5 US gallons in 27.5 min from 18 emitters. This works out to
+        # be 5gal/27.5min*(60min/hour)/18emitters=0.606 GPH per emitter. (The package
+        # says they are 0.65 GPH, only 6.8% difference from what I measured.)
+        #
+        # My system has 62 emitters.
+        # 5gal/27.5min/(60sec/min)/18emitters*62emitters*3.875L/gal = 0.0404L/sec
+        #
+        # Maybe I could just use the rate from the package:
+        # (0.65gal/h)*62emitters=40.3gal/hour
+        self.start("irrigation", "irrigation_model",
+                   lambda m: m.IrrigationModel(us_gallons=40.3, seconds=60*60, area_square_feet=70))
+        # calibrated parameters (see calibrate.py), if there are any
+        def load_soil(soil):
+            soil.load_parameters(config.get('SOIL_PARAMETERS', 'soil_params.json'),
+                                 missing_ok=True)
+            return soil
+        self.start("soil", "soil", load_soil)
+        self.start("log", "log", lambda m: m.Log('log.db'))
+
+        # Sessions look up their forecast in the plan made from the whole
+        # gridpoint download (see planner.py)
+        self.start("planner", "planner",
+                   lambda m: m.Planner(self.weather, self.irrigation,
+                                       config.get('SCHEDULE', "06:00,18:00"),
+                                       file=config.get('PLAN_FILE', 'plan.json')),
+                   # the plan uses the soil model, once its calibrated
+                   # parameters are loaded
+                   after=("weather", "irrigation", "soil"))
+        self.metrics_file = config.get('METRICS_FILE', 'metrics.prom')
+
+        # Closed-loop watering, if a target moisture is set
+        self.feedback_target = config.get('FEEDBACK_TARGET')
+        self.pulse = float(config.get('PULSE_SECONDS', 120))
+        self.soak = float(config.get('SOAK_SECONDS', 600))
+
+        # Weather and soil conditions are gathered concurrently, and must
+        # arrive within SESSION_DEADLINE seconds
+        self.deadline = float(config.get('SESSION_DEADLINE', 60))
+
+        # Background sampler of the soil moisture sensor, used in daemon mode
+        self.sampler = None
+
+
+    def start(self, name, module, create, after=()):
+        """Import module and call create(module) in the background. The
+        result becomes attribute name.
+
+        after:  Names of the objects create() uses. It is only submitted
+                once they have been created, so it never occupies a worker
+                waiting for them (which could deadlock a small pool).
+        """
+        def init():
+            with self.profile.step(f"import {module}"):
+                m = importlib.import_module(module)
+            with self.profile.step(f"create {name}"):
+                return create(m)
+
+        if not after:
+            self.pending[name] = self.pool.submit(init)
+            return
+
+        future = self.pending[name] = Future()
+        lock = threading.Lock()
+        waiting = set(after)
+
+        def submit(dependency):
+            # called as each dependency finishes (errors included; create()
+            # then raises them when it uses the attribute)
+            with lock:
+                waiting.discard(dependency)
+                if waiting:
+                    return
+            try:
+                self.pool.submit(init).add_done_callback(lambda f: copy(f, future))
+            except RuntimeError as e:
+                # the pool was shut down (e.g. the interpreter is exiting)
+                future.set_exception(e)
+
+        for dependency in after:
+            self.pending[dependency].add_done_callback(lambda f, d=dependency: submit(d))
+
+
+    def __getattr__(self, name):
+        # Only called for attributes which don't exist yet: wait for objects
+        # still being created by start(). Errors during creation are raised
+        # here.
+        pending = self.__dict__.get('pending', {})
+        if name not in pending:
+            raise AttributeError(name)
+        value = pending[name].result()
+        setattr(self, name, value)
+        return value
+
+
+    def ready(self):
+        """Wait until every object has been created"""
+        for name in list(self.pending):
+            getattr(self, name)
+        return self
+
+
+    def gather(self):
+        """Get weather and soil conditions concurrently within the deadline
+
+        If the forecast can't be fetched in time, the last forecast downloaded
+        is used instead. If the sensor can't be read in time, the soil model
+        assumes nominal moisture. Returns the conditions and a list of the
+        inputs which were degraded this way.
+        """
+        deadline = time.monotonic() + self.deadline
+
+        # the planner and sensor are looked up in the pool too, since they may
+        # still be starting
+        def timed(stage, function):
+            with metrics.span(stage):
+                return function()
+
+        forecast = self.pool.submit(timed, "weather_fetch",
+                                    lambda: self.planner.forecast(deadline))
+        reading = self.pool.submit(timed, "sensor_read",
+                                   lambda: (self.sampler or self.sensor).measure())
+
+        degraded = []
+        try:
+            forecast = forecast.result(timeout=max(0, deadline - time.monotonic()))
+        except Exception:
+            traceback.print_exc()
+            forecast = self.planner.last_forecast()
+            degraded.append("weather")
+            metrics.increment("degraded_sessions_total", input="weather")
+
+        try:
+            reading = reading.result(timeout=max(0, deadline - time.monotonic()))
+        except Exception:
+            traceback.print_exc()
+            reading = {}
+            degraded.append("sensor")
+            metrics.increment("degraded_sessions_total", input="sensor")
+        return {**forecast, **reading}, degraded
+
+
+    def water(self):
+        """Perform one watering session and log the results
+
+        The metrics are saved even if the session fails, so its errors are
+        counted.
+        """
+        try:
+            return self.session()
+        finally:
+            metrics.save(self.metrics_file, prefix="ogarden_app_")
+
+
+    def session(self):
+        conditions, degraded = self.gather() # get weather and soil conditions
+        with metrics.span("soil_calculate"):
+            water = self.soil.calculate(**conditions) # determine how much watering is needed
+        with metrics.span("millimeters_to_seconds"):
+            duration = self.irrigation.millimeters_to_seconds(water) # determine how long to irrigate
+        results = {**conditions,
+                   "water_amount": water,
+                   "valve_duration": duration}
+
+        if self.feedback_target is None:
+            with metrics.span("valve_timer"):
+                applied = self.valve.timer(duration) # turn on the irrigation for a specified period of time
+            # the actuator caps the duration at VALVE_MAX_DURATION
+            if applied is not None and applied < duration:
+                results["planned_duration"] = duration
+                results["valve_duration"] = applied
+        else:
+            with metrics.span("cycle_soak"):
+                results.update(self.cycle_soak(water, duration))
+        if degraded:
+            results["degraded"] = degraded
+
+        pprint(results)
+
+        # Log the results
+        with metrics.span("log_add"):
+            self.log.add(results)
+
+        metrics.increment("sessions_total")
+
+        return results
+
+
+    def cycle_soak(self, water, duration):
+        """Water in pulses until the soil reaches FEEDBACK_TARGET
+
+        Returns the results of CycleSoak.run() with the depth of water
+        actually applied. The valve_timer stage is only the time the valve
+        was on, without the soaks.
+        """
+        from cycle_soak import CycleSoak
 
-# Set up objects
-weather = NationalWeatherService(latitude=config['LATITUDE'],
-                                 longitude=config['LONGITUDE'], 
-                                 user_agent=config['USER_AGENT']);
-sensor = SoilMoistureSensor(debug=15000)
+        # in daemon mode the sampler owns the sensor, so read through it
+        watering = CycleSoak(self.valve, self.sampler or self.sensor,
+                             float(self.feedback_target),
+                             pulse=self.pulse, soak=self.soak)
+        results = watering.run(duration)
+        metrics.record_stage("valve_timer", watering.valve_seconds)
+        results["water_applied"] = round(water * results["valve_duration"] / duration, 2) \
+                                   if duration else 0
+        metrics.increment("feedback_seconds_saved_total",
+                          duration - results["valve_duration"])
+        return results
 
-# My system filled 5 US gallons in 27.5 min from 18 emitters. This works out to
-# be 5gal/27.5min*(60min/hour)/18emitters=0.606 GPH per emitter. (The package
-# says they are 0.65 GPH, only 6.8% difference from what I measured.)
-#
-# My system has 62 emitters.
-# 5gal/27.5min/(60sec/min)/18emitters*62emitters*3.875L/gal = 0.0404L/sec
-#
-# Maybe I could just use the rate from the package:
-# (0.65gal/h)*62emitters=40.3gal/hour
-irrigation = IrrigationModel(us_gallons=40.3, seconds=60*60, area_square_feet=70)
-valve = Valve()
-log = Log('log.db')
 
+def copy(source, destination):
+    """Set the result or exception of future source on destination"""
+    if source.exception() is not None:
+        destination.set_exception(source.exception())
+    else:
+        destination.set_result(source.result())
 
-# Perform the watering
-conditions = {**weather.fetch(), **sensor.measure()} # get weather and soil conditions
-water = soil.calculate(**conditions) # determine how much watering is needed
-duration = irrigation.millimeters_to_seconds(water) # determine how long to irrigate
-valve.timer(duration) # turn on the irrigation for a specified period of time
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Garden watering application")
+    parser.add_argument('--daemon', action='store_true',
+                        help="stay resident and water on the SCHEDULE in .env "
+                             "(default 06:00,18:00) instead of once")
+    parser.add_argument('--profile-startup', action='store_true',
+                        help="print the time taken by each import and object "
+                             "created at start-up, then exit without watering")
+    args = parser.parse_args()
 
-results = {**conditions,
-           "water_amount": water,
-           "valve_duration": duration}
+    with profile.step("read .env"):
+        from dotenv import dotenv_values
+        config = dotenv_values(".env")
+    garden = Garden(config)
 
-pprint(results)
+    if args.profile_startup:
+        garden.ready()
+        profile.report()
+    elif args.daemon:
+        import scheduler
+        from sampler import Sampler
 
-# Log the results
-log.add(results)
+        store = None
+        if config.get('TELEMETRY_DIR'):
+            from telemetry import TelemetryStore
+            store = TelemetryStore(config['TELEMETRY_DIR'])
 
+        garden.sampler = Sampler(garden.sensor,
+                                 interval=float(config.get('SAMPLE_INTERVAL', 1)),
+                                 store=store).start()
 
+        # the newest log record stands in for the last attempt until one has
+        # been saved to SCHEDULE_STATE
+        newest = garden.log.newest()
+        scheduler.run(scheduler.Schedule(config.get('SCHEDULE', "06:00,18:00")),
+                      garden.water,
+                      last_run=newest and datetime.fromisoformat(newest),
+                      state_file=config.get('SCHEDULE_STATE', 'last_session.txt'))
+    else:
+        garden.water()
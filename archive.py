@@ -0,0 +1,238 @@
+"""Long-term archive of log records in compressed monthly segments
+
+The log only keeps recent records so that it stays small and fast. Records
+that the log cleans out are moved here instead of being deleted, so several
+seasons of history remain available for analysis.
+
+Each calendar month is one segment file, a compressed NumPy .npz archive in
+which every field is a separate column:
+
+    time         Timestamps as microseconds, delta-encoded (the first value
+                 is the absolute time, each following one the difference to
+                 the previous record)
+    n:<field>    Numeric fields as typed arrays: int64 if every record has an
+                 integer value, otherwise float64 with NaN where it is missing
+    i:<field>    For a float64 field which also has integer values, which of
+                 the values were integers (so they are read back as such)
+    other        Any remaining fields of each record as a JSON string
+
+Columns are compressed separately and only decompressed when read, so a query
+for two fields never touches the others.
+"""
+
+import json
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def to_microseconds(isodatetime):
+    return (naive(datetime.fromisoformat(isodatetime)) - EPOCH) // timedelta(microseconds=1)
+
+
+def naive(t):
+    """Log timestamps are naive local times. Convert an aware time to one."""
+    if t.tzinfo is not None:
+        t = t.astimezone().replace(tzinfo=None)
+    return t
+
+
+def normalize(isodatetime):
+    """ISO 8601 string comparable with log timestamps, or None"""
+    if isodatetime is None:
+        return None
+    return naive(datetime.fromisoformat(isodatetime)).isoformat()
+
+
+def from_microseconds(us):
+    return (EPOCH + timedelta(microseconds=int(us))).isoformat()
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def numbers(segment, field, keep=slice(None)):
+    """Values of numeric column field as a list, with integers restored"""
+    values = segment["n:" + field][keep].tolist()
+    if "i:" + field in segment:
+        for i in np.flatnonzero(segment["i:" + field][keep]):
+            values[i] = int(values[i])
+    return values
+
+
+class Archive:
+    """Directory of monthly segment files
+
+    directory:  Where segment files are stored, created when first needed
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+
+    def add(self, records):
+        """Add records (dictionaries with an "isodatetime") to their months
+
+        Timestamps aren't unique, so records from the log also carry its row
+        "id". Records already in the archive (with the same timestamp and id)
+        are replaced, so adding the same record twice is harmless.
+        """
+        months = {}
+        for r in records:
+            months.setdefault(r['isodatetime'][:7], []).append(r)
+
+        for month, new in months.items():
+            old = self.records(month)
+            merged = {(r['isodatetime'], r.get('id', -1)): r for r in old + new}
+            self.write(month, [merged[key] for key in sorted(merged)])
+
+
+    def write(self, month, records):
+        os.makedirs(self.directory, exist_ok=True)
+
+        times = np.array([to_microseconds(r['isodatetime']) for r in records], dtype=np.int64)
+        columns = {"time": np.diff(times, prepend=0)}
+
+        # fields whose values are all numbers (or missing)
+        kinds = {}
+        for r in records:
+            for k, v in r.items():
+                if v is not None:
+                    kinds[k] = kinds.get(k, True) and is_number(v)
+        fields = sorted(k for k, numeric in kinds.items() if numeric)
+        for field in fields:
+            values = [r.get(field) for r in records]
+            if all(isinstance(v, int) for v in values):
+                columns["n:" + field] = np.array(values, dtype=np.int64)
+            else:
+                columns["n:" + field] = np.array([np.nan if v is None else v for v in values],
+                                                 dtype=np.float64)
+                integers = np.array([isinstance(v, int) for v in values])
+                if integers.any():
+                    columns["i:" + field] = integers
+
+        numeric = set(fields) | {"isodatetime"}
+        other = [json.dumps({k: v for k, v in r.items() if k not in numeric}) for r in records]
+        columns["other"] = np.array(other)
+
+        # np.savez_compressed adds ".npz" to names without it, so write a
+        # temporary file with that suffix and rename it into place
+        path = self.path(month)
+        with open(path + ".tmp.npz", 'wb') as f:
+            np.savez_compressed(f, **columns)
+        os.replace(path + ".tmp.npz", path)
+
+
+    def path(self, month):
+        return os.path.join(self.directory, month + ".npz")
+
+
+    def months(self, since=None, until=None):
+        """Return the months with segments which may hold records in the range"""
+        since, until = normalize(since), normalize(until)
+        if not os.path.isdir(self.directory):
+            return []
+        months = sorted(name[:-4] for name in os.listdir(self.directory)
+                        if name.endswith(".npz") and not name.endswith(".tmp.npz"))
+        return [m for m in months
+                if (since is None or m >= since[:7]) and (until is None or m <= until[:7])]
+
+
+    def query(self, fields, since=None, until=None):
+        """Return fields of the archived records in a range as columns
+
+        since, until:  ISO 8601 strings, since inclusive and until exclusive
+
+        Returns a dictionary with a list of "isodatetime" values and a list
+        for each field (None where a record doesn't have the field), like
+        Log.series(). Only the requested columns are decompressed.
+        """
+        since, until = normalize(since), normalize(until)
+        columns = {"isodatetime": []}
+        columns.update({field: [] for field in fields})
+
+        for month in self.months(since, until):
+            with np.load(self.path(month)) as segment:
+                times = np.cumsum(segment["time"])
+                keep = np.ones(len(times), dtype=bool)
+                if since is not None:
+                    keep &= times >= to_microseconds(since)
+                if until is not None:
+                    keep &= times < to_microseconds(until)
+                if not keep.any():
+                    continue
+
+                columns["isodatetime"] += [from_microseconds(t) for t in times[keep]]
+
+                other = None
+                for field in fields:
+                    if "n:" + field in segment:
+                        values = numbers(segment, field, keep)
+                        columns[field] += [None if v != v else v for v in values]
+                    else:
+                        if other is None:
+                            other = [json.loads(o) for o in segment["other"][keep]]
+                        columns[field] += [o.get(field) for o in other]
+
+        return columns
+
+
+    def records(self, month):
+        """Return all records of a month as dictionaries, oldest first"""
+        if not os.path.exists(self.path(month)):
+            return []
+
+        with np.load(self.path(month)) as segment:
+            times = np.cumsum(segment["time"])
+            records = [json.loads(o) for o in segment["other"]]
+            for i, t in enumerate(times):
+                records[i]["isodatetime"] = from_microseconds(t)
+            for name in segment.files:
+                if name.startswith("n:"):
+                    for r, v in zip(records, numbers(segment, name[2:])):
+                        if v == v:  # not NaN
+                            r[name[2:]] = v
+        return records
+
+
+    def __len__(self):
+        total = 0
+        for month in self.months():
+            with np.load(self.path(month)) as segment:
+                total += len(segment["time"])
+        return total
+
+
+if __name__ == "__main__":
+    import random
+    import tempfile
+
+    records = []
+    t = datetime(2020, 4, 1, 6)
+    for i in range(2*365*2):
+        records.append({"isodatetime": (t + timedelta(hours=12*i, seconds=random.random())).isoformat(),
+                        "water_amount": round(random.uniform(0, 5), 2),
+                        "valve_duration": round(random.uniform(0, 300), 1),
+                        "sensor_value": random.choice([random.randint(300, 900), 612.5]),
+                        "ave_temperature": round(random.uniform(5, 35), 2),
+                        "total_precipitation": round(random.uniform(0, 10), 2)})
+    records[5]["degraded"] = ["weather"]
+    # records sharing a timestamp are kept apart by their log ids
+    records[7:9] = [{**records[7], "id": 1}, {**records[7], "id": 2, "water_amount": 0}]
+
+    archive = Archive(tempfile.mkdtemp())
+    archive.add(records)
+    size = sum(os.path.getsize(archive.path(m)) for m in archive.months())
+    print(f"{len(archive)} records in {len(archive.months())} segments, "
+          f"{size} bytes ({len(json.dumps(records))} bytes of JSON)")
+
+    columns = archive.query(["water_amount", "degraded"], since="2021-01-01", until="2021-02-01")
+    print(f"January 2021: {len(columns['isodatetime'])} records")
+    assert archive.records(records[5]["isodatetime"][:7])[5] == records[5]
+    assert len(archive) == len(records)
+    month = archive.records(records[0]["isodatetime"][:7])
+    assert [type(r["sensor_value"]) for r in month] == [type(r["sensor_value"]) for r in records[:len(month)]]
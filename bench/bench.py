@@ -0,0 +1,324 @@
+"""Benchmarks of the watering pipeline and web API
+
+Runs without any hardware or network: GPIO uses gpiozero's MockFactory, the
+I2C bus is a fake SMBus, and the NWS API is a local stand-in server serving
+the recorded responses in bench/fixtures.
+
+Usage (from the project directory):
+    python bench/bench.py --output results.json
+    python bench/bench.py --compare results.json
+
+Results are JSON: one entry per benchmark with its parameters and timings in
+seconds per operation. --compare prints the change against an earlier results
+file, and exits with an error if any benchmark got slower than --threshold.
+
+The start-up of app.py is timed in fresh interpreters, and the benchmarks also
+exit with an error if it takes longer than --startup-budget seconds.
+
+To record fresh fixtures from the NWS for your own location:
+    python bench/bench.py --record 38.8894,-77.0352 --user-agent "Name email"
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(BENCH_DIR)
+FIXTURES = os.path.join(BENCH_DIR, "fixtures")
+sys.path.insert(0, PROJECT_ROOT)
+
+
+# Mock hardware before any project module touches it
+import mock_hardware
+
+
+def measure(fn, repeat=5, number=None, min_time=0.2):
+    """Time fn, returning seconds per call for each of repeat runs
+
+    If number isn't given, it is chosen so that one run takes min_time.
+    """
+    if number is None:
+        number = 1
+        while True:
+            start = time.perf_counter()
+            for _ in range(number):
+                fn()
+            if time.perf_counter() - start >= min_time / repeat or number >= 1e6:
+                break
+            number *= 4
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        times.append((time.perf_counter() - start) / number)
+    return times, number
+
+
+class Results:
+    def __init__(self):
+        self.entries = []
+
+    def add(self, name, fn, **params):
+        times, number = measure(fn, **{k: params.pop(k) for k in ('repeat', 'number') if k in params})
+        entry = {"name": name,
+                 "params": params,
+                 "number": number,
+                 "min": min(times),
+                 "median": statistics.median(times),
+                 "ops_per_sec": 1 / statistics.median(times)}
+        self.entries.append(entry)
+        label = name + "".join(f" {k}={v}" for k, v in params.items())
+        print(f"{label:45} {entry['median']*1e6:12.1f} us/op  ({number} x {len(times)})")
+
+
+def bench_log(results, sizes, tmp):
+    from log import Log
+
+    for n in sizes:
+        path = os.path.join(tmp, f"log{n}.db")
+        log = Log(path, max_records=n)
+        t = datetime.now() - timedelta(hours=12*n)
+        record = {"water_amount": 1.2, "valve_duration": 184.2, "sensor_value": 36.4,
+                  "ave_temperature": 21.3, "total_precipitation": 0.0}
+        with log.db:
+            log.db.executemany("INSERT INTO log (isodatetime, record) VALUES (?, ?)",
+                               [((t + timedelta(hours=12*i)).isoformat(),
+                                 json.dumps({**record, "isodatetime": (t + timedelta(hours=12*i)).isoformat()}))
+                                for i in range(n)])
+        log.max_days = 100*365  # keep every record, measure the record limit only
+
+        results.add("log.add", lambda: log.add(dict(record)), records=n, repeat=3)
+        results.add("log.clean", log.clean, records=n, repeat=3)
+        results.add("log.tail", lambda: log.tail(60), records=n, limit=60)
+        results.add("log.tail", lambda: log.tail(1000), records=n, limit=1000)
+
+
+def stand_in_server():
+    """Serve the fixtures like api.weather.gov, returning the server URL"""
+    with open(os.path.join(FIXTURES, "points.json")) as f:
+        points = json.load(f)
+    with open(os.path.join(FIXTURES, "gridpoint.json"), 'rb') as f:
+        gridpoint = f.read()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            if self.path.startswith("/points/"):
+                body = dict(points)
+                body["properties"] = {**points["properties"],
+                                      "forecastGridData": url + "/gridpoints/LWX/96,70"}
+                body = json.dumps(body).encode()
+            else:
+                body = gridpoint
+            self.send_response(200)
+            self.send_header("Content-Type", "application/geo+json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}"
+    return server, url
+
+
+def bench_weather(results, tmp):
+    import weather
+
+    server, url = stand_in_server()
+    nws = weather.NationalWeatherService(api_server=url, cache_dir=os.path.join(tmp, "cache"))
+    results.add("weather.fetch", nws.fetch, fixture="gridpoint.json")
+
+    with open(os.path.join(FIXTURES, "gridpoint.json")) as f:
+        grid = json.load(f)
+    results.add("weather.parse", lambda: weather.Forecast(grid), fixture="gridpoint.json")
+    forecast = weather.Forecast(grid)
+    now = datetime.fromisoformat("2021-06-01T12:00:00+00:00")
+    results.add("weather.summarize", lambda: forecast.summarize([6, 12, 24, 72], now=now), windows=4)
+    server.shutdown()
+
+
+def bench_models(results):
+    import numpy as np
+    import soil
+    from irrigation_model import IrrigationModel
+
+    soil.DEBUG = False
+    now = datetime(2021, 7, 1, 6)
+    conditions = dict(ave_probability_of_precipitation=20, ave_relative_humidity=60,
+                      ave_sky_cover=40, ave_temperature=24, ave_wind_gust=15,
+                      ave_wind_speed=8, total_precipitation=0.5, sensor_value=45)
+    results.add("soil.calculate", lambda: soil.calculate(**conditions, now=now))
+
+    n = 10000
+    arrays = {k: np.full(n, v, dtype=float) for k, v in conditions.items()}
+    results.add("soil.calculate_batch", lambda: soil.calculate_batch(**arrays, now=now), batch=n)
+
+    irrigation = IrrigationModel(us_gallons=40.3, seconds=60*60, area_square_feet=70)
+    results.add("irrigation.millimeters_to_seconds", lambda: irrigation.millimeters_to_seconds(2.5))
+
+
+def bench_api(results, tmp):
+    # api.py finds the project root and .env at ../.. of the working directory
+    root = os.path.join(tmp, "root")
+    os.makedirs(os.path.join(root, "web", "api"))
+    with open(os.path.join(root, ".env"), 'w') as f:
+        f.write("LOG=bench_log.db\n")
+    cwd = os.getcwd()
+    os.chdir(os.path.join(root, "web", "api"))
+    sys.path.insert(0, os.path.join(PROJECT_ROOT, "web", "api"))
+    try:
+        import api
+
+        with api.log.db:
+            t = datetime.now() - timedelta(days=300)
+            api.log.db.executemany(
+                "INSERT INTO log (isodatetime, record) VALUES (?, ?)",
+                [((t + timedelta(hours=12*i)).isoformat(),
+                  json.dumps({"water_amount": 1.0, "ave_temperature": 20.0,
+                              "isodatetime": (t + timedelta(hours=12*i)).isoformat()}))
+                 for i in range(600)])
+
+        client = api.app.test_client()
+        results.add("api /api/log", lambda: client.get("/api/log?limit=60"), limit=60)
+        etag = client.get("/api/log?limit=60").headers["ETag"]
+        results.add("api /api/log", lambda: client.get("/api/log?limit=60",
+                                                       headers={"If-None-Match": etag}),
+                    limit=60, cached=True)
+        results.add("api /api/sensor", lambda: client.get("/api/sensor"))
+        results.add("api /api/sensor", lambda: client.get("/api/sensor?fresh=1"), fresh=True)
+    finally:
+        os.chdir(cwd)
+
+
+def bench_startup(results, tmp, budget):
+    """Time "python app.py --profile-startup" in fresh interpreters
+
+    Returns True if the fastest start-up took at most budget seconds.
+    """
+    server, url = stand_in_server()
+    root = os.path.join(tmp, "startup")
+    os.makedirs(root)
+    with open(os.path.join(root, ".env"), 'w') as f:
+        f.write(f"LATITUDE=38.8894\nLONGITUDE=-77.0352\nUSER_AGENT=bench\n"
+                f"NWS_API_SERVER={url}\n")
+
+    code = ("import mock_hardware, runpy, sys; "
+            "sys.argv = ['app.py', '--profile-startup']; "
+            f"runpy.run_path({os.path.join(PROJECT_ROOT, 'app.py')!r}, run_name='__main__')")
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join([BENCH_DIR, PROJECT_ROOT])}
+
+    def start():
+        subprocess.run([sys.executable, "-c", code], cwd=root, env=env, check=True,
+                       stdout=subprocess.DEVNULL)
+
+    # the first run looks up the grid, which later runs read from the cache
+    start()
+    results.add("app.startup", start, repeat=5, number=1)
+    server.shutdown()
+
+    seconds = results.entries[-1]["min"]
+    if seconds > budget:
+        print(f"app.startup took {seconds:.2f}s, over the budget of {budget:.2f}s")
+        return False
+    return True
+
+
+def compare(entries, baseline_file, threshold):
+    """Print the change of each benchmark against a baseline; True if none regressed"""
+    with open(baseline_file) as f:
+        baseline = {(e["name"], json.dumps(e["params"], sort_keys=True)): e
+                    for e in json.load(f)["results"]}
+
+    ok = True
+    print(f"\n{'benchmark':45} {'ratio':>8}")
+    for e in entries:
+        b = baseline.get((e["name"], json.dumps(e["params"], sort_keys=True)))
+        if b is None:
+            continue
+        # the fastest run is the least affected by other load on the machine
+        ratio = e["min"] / b["min"]
+        flag = "  REGRESSION" if ratio > threshold else ""
+        ok = ok and not flag
+        label = e["name"] + "".join(f" {k}={v}" for k, v in e["params"].items())
+        print(f"{label:45} {ratio:8.2f}{flag}")
+    return ok
+
+
+def record(location, user_agent):
+    """Save the NWS responses for location as fixtures"""
+    import requests
+
+    headers = {"User-Agent": user_agent}
+    points = requests.get(f"https://api.weather.gov/points/{location}", headers=headers)
+    points.raise_for_status()
+    grid = requests.get(points.json()["properties"]["forecastGridData"], headers=headers)
+    grid.raise_for_status()
+    with open(os.path.join(FIXTURES, "points.json"), 'w') as f:
+        json.dump(points.json(), f, indent=2)
+    with open(os.path.join(FIXTURES, "gridpoint.json"), 'w') as f:
+        json.dump(grid.json(), f)
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=PROJECT_ROOT,
+                              capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ogarden benchmarks")
+    parser.add_argument('--output', help="write results to this JSON file")
+    parser.add_argument('--compare', help="compare with an earlier results file")
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help="slowdown ratio counted as a regression (default 1.25)")
+    parser.add_argument('--startup-budget', type=float, default=1.5,
+                        help="longest acceptable app.py start-up in seconds (default 1.5)")
+    parser.add_argument('--quick', action='store_true', help="only the 1k log size")
+    parser.add_argument('--record', metavar="LAT,LON", help="record NWS fixtures and exit")
+    parser.add_argument('--user-agent', default="ogarden benchmarks")
+    args = parser.parse_args()
+
+    if args.record:
+        record(args.record, args.user_agent)
+        sys.exit()
+
+    results = Results()
+    with tempfile.TemporaryDirectory() as tmp:
+        bench_log(results, [1000] if args.quick else [1000, 10000, 100000], tmp)
+        bench_weather(results, tmp)
+        bench_models(results)
+        bench_api(results, tmp)
+        ok = bench_startup(results, tmp, args.startup_budget)
+
+    output = {"time": datetime.now().isoformat(),
+              "revision": git_revision(),
+              "python": platform.python_version(),
+              "machine": platform.machine(),
+              "results": results.entries}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+
+    if args.compare and not compare(results.entries, args.compare, args.threshold):
+        ok = False
+    if not ok:
+        sys.exit(1)
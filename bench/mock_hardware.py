@@ -0,0 +1,31 @@
+"""Mock hardware for the benchmarks
+
+Import this before any project module. GPIO uses gpiozero's MockFactory, and
+the smbus2 module is replaced by one whose SMBus returns a fixed sensor
+response. Neither gpiozero nor smbus2 is imported here, so start-up
+benchmarks still pay for importing the project's own dependencies.
+"""
+
+import os
+import sys
+import types
+
+os.environ["GPIOZERO_PIN_FACTORY"] = "mock"
+
+
+class FakeSMBus:
+    """Stands in for smbus2.SMBus with a fixed sensor response"""
+
+    def __init__(self, port=None):
+        self.port = port
+
+    def read_i2c_block_data(self, address, offset, length):
+        return list((15000).to_bytes(length, 'little'))
+
+    def close(self):
+        pass
+
+
+smbus2 = types.ModuleType("smbus2")
+smbus2.SMBus = FakeSMBus
+sys.modules["smbus2"] = smbus2
@@ -0,0 +1,224 @@
+"""Fit the soil model parameters to the logged watering sessions
+
+The soil model (soil.py) aims to bring the soil to SENSOR_NOMINAL by the next
+session. The log shows whether it did: each session records the conditions
+and the water applied, and the next session records the sensor_value that
+resulted. Calibration fits a water balance to consecutive sessions,
+
+    next sensor_value - sensor_value = gain * water
+                                       + c0 + c_humidity * humidity
+                                       + c_sky * sky_cover
+                                       + c_temperature * temperature
+                                       + c_wind * wind + c_rain * precipitation
+                                       + c_days * days into the season
+
+by linear least squares, and then solves for the parameters with which
+calculate() returns the water that brings the soil to SENSOR_NOMINAL. The
+nominal values stay as they are, since the model has more parameters than the
+balance can determine.
+
+The uncertainty of each parameter is estimated by refitting bootstrap
+resamples of the sessions. Resamples are solved in vectorized batches spread
+across a process pool.
+
+Usage:
+    python calibrate.py --log log.db --output soil_params.json
+
+The parameter file is loaded by soil.load_parameters() (app.py does this at
+start-up if the file exists).
+"""
+
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import numpy as np
+
+import soil
+from log import Log
+
+FIELDS = ["sensor_value", "water_amount", "water_applied",
+          "ave_relative_humidity", "ave_sky_cover", "ave_temperature",
+          "ave_wind_speed", "ave_wind_gust", "total_precipitation"]
+
+# Columns of the design matrix
+COLUMNS = ["water", "constant", "humidity", "sky_cover", "temperature",
+           "wind", "precipitation", "days"]
+
+
+def load(columns, max_gap_hours=36):
+    """Return the design matrix and response from log columns
+
+    Each session is paired with the next one if it followed within
+    max_gap_hours. Sessions with missing conditions are skipped.
+    """
+    times = np.array(columns['isodatetime'], dtype='datetime64[us]')
+    order = np.argsort(times)
+    times = times[order]
+
+    def column(name):
+        return np.array([np.nan if v is None else v for v in columns[name]], dtype=float)[order]
+
+    sensor = column('sensor_value')
+    # cycle-and-soak sessions record the water actually applied
+    water = np.where(np.isnan(column('water_applied')), column('water_amount'),
+                     column('water_applied'))
+    X = np.column_stack([water,
+                         np.ones(len(times)),
+                         column('ave_relative_humidity'),
+                         column('ave_sky_cover'),
+                         column('ave_temperature'),
+                         (column('ave_wind_speed') + column('ave_wind_gust')) / 2,
+                         column('total_precipitation'),
+                         soil.season_days(times).astype(float)])
+
+    gap = (times[1:] - times[:-1]) / np.timedelta64(1, 'h')
+    X, y = X[:-1], sensor[1:] - sensor[:-1]
+    valid = (gap <= max_gap_hours) & ~np.isnan(X).any(axis=1) & ~np.isnan(y)
+    return X[valid], y[valid]
+
+
+def fit(X, y, samples=None):
+    """Least-squares coefficients of y on X, for each resample of rows
+
+    samples:  None for one fit of all rows, or an array of row indices shaped
+              (resamples, rows), solved as one batch
+
+    Returns coefficients shaped (len(COLUMNS),) or (resamples, len(COLUMNS)).
+    """
+    if samples is None:
+        return np.linalg.lstsq(X, y, rcond=None)[0]
+
+    Xs, ys = X[samples], y[samples]
+    XtX = np.einsum('kni,knj->kij', Xs, Xs)
+    Xty = np.einsum('kni,kn->ki', Xs, ys)
+    # resamples which happen to be singular get NaN coefficients
+    coefficients = np.full(Xty.shape, np.nan)
+    solvable = np.linalg.matrix_rank(XtX) == X.shape[1]
+    coefficients[solvable] = np.linalg.solve(XtX[solvable], Xty[solvable][..., None])[..., 0]
+    return coefficients
+
+
+def to_parameters(coefficients, nominals=None):
+    """Convert water balance coefficients to soil model parameters
+
+    Works on a single set of coefficients or an array of them (one per row).
+    Returns a dictionary of PARAMETERS (arrays for an array of coefficients).
+    """
+    n = nominals or soil.parameters()
+    gain, c0, c_h, c_k, c_t, c_w, c_p, c_d = np.moveaxis(np.asarray(coefficients), -1, 0)
+
+    # water which balances the loss at nominal conditions on the first day
+    base = -(c0 + n['HUMIDITY_NOMINAL'] * c_h + n['SKYCOVER_NOMINAL'] * c_k +
+             n['TEMPERATURE_NOMINAL'] * c_t + n['WIND_NOMINAL'] * c_w) / gain
+
+    return {"BASE_WATER_AMOUNT": base,
+            "PRECIPITATION_K": c_p / gain,
+            "HUMIDITY_NOMINAL": n['HUMIDITY_NOMINAL'],
+            "HUMIDITY_K": n['HUMIDITY_NOMINAL'] * c_h / gain / base,
+            "SKYCOVER_NOMINAL": n['SKYCOVER_NOMINAL'],
+            "SKYCOVER_K": n['SKYCOVER_NOMINAL'] * c_k / gain / base,
+            "TEMPERATURE_NOMINAL": n['TEMPERATURE_NOMINAL'],
+            "TEMPERATURE_K": -n['TEMPERATURE_NOMINAL'] * c_t / gain / base,
+            "WIND_NOMINAL": n['WIND_NOMINAL'],
+            "WIND_K": -n['WIND_NOMINAL'] * c_w / gain / base,
+            "SENSOR_NOMINAL": n['SENSOR_NOMINAL'],
+            "SENSOR_K": n['SENSOR_NOMINAL'] / gain / base,
+            "SEASON_K": -c_d / gain / base}
+
+
+def bootstrap_chunk(X, y, resamples, seed):
+    """Parameters fitted to resamples of the sessions, as an array per parameter"""
+    rng = np.random.default_rng(seed)
+    samples = rng.integers(0, len(y), size=(resamples, len(y)))
+    return to_parameters(fit(X, y, samples))
+
+
+def bootstrap(X, y, resamples=200, workers=None, chunk=50, seed=0):
+    """Standard deviation of each parameter over bootstrap resamples"""
+    chunks = [min(chunk, resamples - i) for i in range(0, resamples, chunk)]
+    seeds = np.random.SeedSequence(seed).spawn(len(chunks))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(bootstrap_chunk,
+                                [X] * len(chunks), [y] * len(chunks), chunks, seeds))
+    return {name: float(np.nanstd(np.concatenate([np.atleast_1d(r[name]) for r in results])))
+            for name in soil.PARAMETERS}
+
+
+def calibrate(columns, max_gap_hours=36, resamples=200, workers=None):
+    """Fit the parameters to log columns (see Log.history())
+
+    Returns a dictionary for the parameter file. Raises ValueError if the log
+    doesn't determine the parameters.
+    """
+    X, y = load(columns, max_gap_hours)
+    if len(y) <= len(COLUMNS):
+        raise ValueError(f"Only {len(y)} pairs of consecutive sessions, "
+                         f"at least {len(COLUMNS) + 1} are needed")
+
+    coefficients = fit(X, y)
+    gain = coefficients[0]
+    params = to_parameters(coefficients)
+    if gain <= 0 or params["BASE_WATER_AMOUNT"] <= 0:
+        raise ValueError(f"The log doesn't show water raising the sensor value "
+                         f"(gain {gain:.3g}, base {params['BASE_WATER_AMOUNT']:.3g}); "
+                         f"more varied sessions are needed")
+
+    residuals = y - X @ coefficients
+    return {"parameters": {name: float(value) for name, value in params.items()},
+            "uncertainty": bootstrap(X, y, resamples, workers) if resamples else None,
+            "fit": {"sessions": int(len(y)),
+                    "r2": float(1 - residuals.var() / y.var()) if y.var() else None,
+                    "residual_std": float(residuals.std()),
+                    "coefficients": dict(zip(COLUMNS, map(float, coefficients)))}}
+
+
+def save(result, file):
+    """Write a parameter file, one revision newer than the file it replaces
+
+    The previous file is kept with its revision number as a suffix.
+    """
+    revision = 0
+    if os.path.exists(file):
+        with open(file) as f:
+            revision = json.load(f).get('revision', 0)
+        os.replace(file, f"{file}.{revision}")
+
+    data = {"version": soil.PARAMETER_FILE_VERSION,
+            "revision": revision + 1,
+            "created": datetime.now().isoformat(),
+            **result}
+    with open(file + ".tmp", 'w') as f:
+        json.dump(data, f, indent=2)
+    os.replace(file + ".tmp", file)
+    return data
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--log', default="log.db", help="log database file")
+    parser.add_argument('--output', default="soil_params.json", help="parameter file to write")
+    parser.add_argument('--max-gap', type=float, default=36,
+                        help="longest time in hours between sessions paired up (default 36)")
+    parser.add_argument('--bootstrap', type=int, default=200,
+                        help="resamples for the uncertainty estimate, 0 to skip (default 200)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--dry-run', action='store_true', help="print, don't write the file")
+    args = parser.parse_args()
+
+    soil.DEBUG = False
+    columns = Log(args.log).history(FIELDS)
+    result = calibrate(columns, args.max_gap, args.bootstrap, args.workers)
+
+    current = soil.parameters()
+    print(f"Fitted {result['fit']['sessions']} sessions, r2 {result['fit']['r2']:.3f}")
+    print(f"{'parameter':22} {'current':>10} {'fitted':>10} {'+/-':>10}")
+    for name in soil.PARAMETERS:
+        error = result['uncertainty'][name] if result['uncertainty'] else float('nan')
+        print(f"{name:22} {current[name]:10.4g} {result['parameters'][name]:10.4g} {error:10.2g}")
+
+    if not args.dry_run:
+        data = save(result, args.output)
+        print(f"Wrote revision {data['revision']} to {args.output}")
@@ -0,0 +1,132 @@
+"""Closed-loop "cycle and soak" watering driven by the soil moisture sensor
+
+The open-loop session turns the valve on once for the duration computed from
+the soil and irrigation models. Cycle and soak instead waters in short pulses
+with a soak after each one, so the water can sink in, and reads the soil
+moisture sensor throughout. The session stops as soon as the soil reaches the
+target moisture, so soil which is already nearly wet enough gets only a
+fraction of the computed water, or none.
+
+The computed duration is an upper bound: the pulses never add up to more than
+it, and neither a pulse nor a soak is ever longer than it.
+
+Usage:
+    watering = CycleSoak(valve, sensor, target=60, pulse=120, soak=600)
+    result = watering.run(duration)   # duration from millimeters_to_seconds
+"""
+
+from datetime import datetime
+from time import monotonic, sleep
+
+
+class CycleSoak:
+    """Waters in pulses until the soil reaches a target moisture
+
+    valve:            Valve (or RemoteValve)
+    sensor:           SoilMoistureSensor, or anything with the same measure().
+                      Use the Sampler if one is reading the sensor.
+    target:           Target sensor_value (percent moisture)
+    pulse:            Longest pulse in seconds
+    soak:             Soak in seconds after each pulse
+    sample_interval:  Seconds between sensor readings during a soak
+    debug:            Outputs debugging messages
+    """
+
+    def __init__(self, valve, sensor, target, pulse=120, soak=600,
+                 sample_interval=30, debug=False):
+        self.valve = valve
+        self.sensor = sensor
+        self.target = target
+        self.pulse = pulse
+        self.soak = soak
+        self.sample_interval = sample_interval
+        self.debug = debug
+
+
+    def run(self, duration):
+        """Water for at most duration seconds, stopping at the target
+
+        Returns a dictionary for the log with the seconds the valve was on
+        ("valve_duration"), why watering stopped ("stopped" is "target" or
+        "duration"), and each pulse with the sensor trajectory during the
+        pulse and its soak, as [seconds since the start of the session,
+        sensor_value] pairs. Afterwards, valve_seconds is the measured time
+        the valve was on, without the soaks.
+        """
+        self.start = monotonic()
+        self.valve_seconds = 0  # measured time the valve was on
+        pulse = min(self.pulse, duration)
+        soak = min(self.soak, duration)
+        remaining = duration
+        pulses = []
+
+        value = self.read()
+        start_value = value
+        while remaining > 0 and value < self.target:
+            seconds = min(pulse, remaining)
+            if self.debug: print(f"{datetime.now()} | Pulse of {seconds:.1f}s at {value}%")
+            trajectory = [[self.elapsed(), value]]
+            opened = monotonic()
+            applied = self.valve.timer(seconds)
+            if applied is not None:
+                seconds = applied  # capped by the actuator's max_duration
+            self.valve_seconds += monotonic() - opened
+            remaining -= seconds
+            value = self.read()
+            trajectory.append([self.elapsed(), value])
+
+            # sample the soil while the water soaks in, and stop early if it
+            # is wet enough. There is no soak after the last pulse.
+            end = monotonic() + (soak if remaining > 0 else 0)
+            while monotonic() < end and value < self.target:
+                sleep(max(0, min(self.sample_interval, end - monotonic())))
+                value = self.read()
+                trajectory.append([self.elapsed(), value])
+
+            pulses.append({"seconds": seconds, "trajectory": trajectory})
+
+        if self.debug: print(f"{datetime.now()} | Stopped at {value}%")
+
+        return {"valve_duration": round(duration - remaining, 1),
+                "planned_duration": duration,
+                "stopped": "target" if value >= self.target else "duration",
+                "start_sensor_value": start_value,
+                "end_sensor_value": value,
+                "pulses": pulses}
+
+
+    def read(self):
+        return self.sensor.measure()["sensor_value"]
+
+
+    def elapsed(self):
+        return round(monotonic() - self.start, 1)
+
+
+if __name__ == "__main__":
+    from pprint import pprint
+
+    # Simulated soil which gets 1% wetter for every 10 s of water, with a
+    # simulated clock so the demo doesn't wait
+    clock = [0.0]
+    monotonic = lambda: clock[0]
+
+    def sleep(seconds):
+        clock[0] += seconds
+
+    class Soil:
+        moisture = 52.0
+
+        def measure(self):
+            return {"sensor_value": round(self.moisture, 2)}
+
+    class Valve:
+        def timer(self, duration):
+            sleep(duration)
+            soil.moisture += duration / 10
+
+    soil = Soil()
+    pprint(CycleSoak(Valve(), soil, target=60, pulse=30, soak=300, debug=True).run(300))
+
+    soil.moisture = 59.5
+    pprint(CycleSoak(Valve(), soil, target=60, pulse=30, soak=300).run(300))
@@ -0,0 +1,190 @@
+"""Shared forecasts for many gardens or zones
+
+Every NationalWeatherService looks up its own NWS grid cell and downloads the
+gridpoint forecast for it. Gardens close together usually share a grid cell
+(about 2.5 km across), so a fleet of them would download and parse the same
+document again and again.
+
+FleetForecast groups locations by grid cell instead. Each distinct grid is
+downloaded and parsed at most once per update interval, and every location
+in it is served from that shared Forecast. Summaries depend only on the grid,
+so they are computed once per grid as well.
+
+Usage:
+    fleet = FleetForecast(user_agent="Name email")
+    front = fleet.add("front", 38.8894, -77.0352)
+    back = fleet.add("back", 38.8895, -77.0351)
+    front.fetch()            # same methods as NationalWeatherService
+    fleet.summaries([12])    # {name: {12: summary}} for every location
+"""
+
+import threading
+import time
+from pprint import pprint
+
+import metrics
+from http_cache import HttpCache
+from weather import Forecast, grid_url
+
+
+class FleetForecast:
+    """Forecasts for many locations, fetched once per NWS grid cell
+
+    user_agent:  Requirement of National Weather Service (see weather.py)
+    interval:    Seconds before a grid is downloaded again
+    api_server:  Defaults to primary NWS server
+    cache_dir:   Directory for cached API responses
+    """
+
+    def __init__(self, user_agent="myweatherapp.com, contact@myweatherapp.com",
+                 interval=60*60,
+                 api_server="https://api.weather.gov",
+                 cache_dir=".nws_cache",
+                 debug=False):
+        self.interval = interval
+        self.api_server = api_server
+        self.debug = debug
+        self.cache = HttpCache(cache_dir, headers={'User-Agent': user_agent}, debug=debug)
+
+        self.locations = {}  # name -> grid URL
+        self.grids = {}      # grid URL -> [updated (monotonic), Forecast, {windows: summaries}, JSON]
+        self.grid_locks = {} # grid URL -> Lock of its download and summaries
+        self.lock = threading.Lock()
+
+
+    def add(self, name, latitude, longitude, forecast_hours=12):
+        """Add a location, returning a FleetLocation for it"""
+        url = grid_url(self.cache, self.api_server, latitude, longitude)
+        with self.lock:
+            self.locations[name] = url
+        if self.debug: print(f"{name} is in grid {url}")
+        return FleetLocation(self, name, forecast_hours)
+
+
+    def forecast(self, name, deadline=None):
+        """Return the shared Forecast of the grid that name is in"""
+        return self.update(self.locations[name], deadline)[1]
+
+
+    def grid(self, name, deadline=None):
+        """Return the gridpoint forecast JSON of the grid that name is in"""
+        return self.update(self.locations[name], deadline)[3]
+
+
+    def grid_lock(self, url):
+        with self.lock:
+            return self.grid_locks.setdefault(url, threading.Lock())
+
+
+    def update(self, url, deadline=None):
+        """Download and parse grid url unless it was updated within interval
+
+        Each grid has its own lock, which makes concurrent callers in the
+        same grid wait for one download instead of each starting their own.
+        Callers in other grids don't wait.
+        """
+        with self.grid_lock(url):
+            with self.lock:
+                grid = self.grids.get(url)
+            if grid is None or time.monotonic() - grid[0] >= self.interval:
+                response = self.cache.get(url, deadline=deadline)
+                forecast = Forecast(response)
+                metrics.increment("fleet_grid_updates_total")
+                grid = [time.monotonic(), forecast, {}, response]
+                with self.lock:
+                    self.grids[url] = grid
+            return grid
+
+
+    def summaries(self, windows=(12,), deadline=None):
+        """Return {name: {hours: summary}} for every location
+
+        Each distinct grid is summarized once. Locations in the same grid
+        share the same summary dictionaries.
+        """
+        windows = tuple(windows)
+        by_grid = {}
+        for url in set(self.locations.values()):
+            by_grid[url] = self.summarize(url, windows, deadline)
+        return {name: by_grid[url] for name, url in self.locations.items()}
+
+
+    def summarize(self, url, windows, deadline=None):
+        """Summaries of grid url, computed at most once a minute"""
+        _, forecast, summaries, _ = self.update(url, deadline)
+        minute = int(time.time() // 60)
+        with self.grid_lock(url):
+            if (windows, minute) not in summaries:
+                summaries.clear()
+                summaries[(windows, minute)] = forecast.summarize(windows)
+            return summaries[(windows, minute)]
+
+
+    def last_forecast(self, name):
+        """Return the last Forecast downloaded for name, however old.
+        Raises LookupError if there is none.
+        """
+        url = self.locations[name]
+        with self.lock:
+            if url in self.grids:
+                return self.grids[url][1]
+        grid = self.cache.last(url)
+        if grid is None:
+            raise LookupError("No forecast has been downloaded yet")
+        return Forecast(grid)
+
+
+    def __len__(self):
+        """Number of distinct grids"""
+        return len(set(self.locations.values()))
+
+
+class FleetLocation:
+    """One location of a FleetForecast
+
+    Has the same fetch methods as NationalWeatherService (including grid(),
+    which the Planner uses), so it can be used in its place (e.g. as
+    Garden.weather).
+    """
+
+    def __init__(self, fleet, name, forecast_hours=12):
+        self.fleet = fleet
+        self.name = name
+        self.forecast_hours = forecast_hours
+
+
+    def fetch(self, deadline=None):
+        """Return the forecast summary over the next forecast_hours"""
+        return self.fetch_windows([self.forecast_hours], deadline)[self.forecast_hours]
+
+
+    def fetch_windows(self, windows=(6, 12, 24, 72), deadline=None):
+        """Return forecast summaries for several windows, keyed by hours"""
+        url = self.fleet.locations[self.name]
+        return self.fleet.summarize(url, tuple(windows), deadline)
+
+
+    def forecast(self, deadline=None):
+        return self.fleet.forecast(self.name, deadline)
+
+
+    def grid(self, deadline=None):
+        return self.fleet.grid(self.name, deadline)
+
+
+    def last_forecast(self):
+        forecast = self.fleet.last_forecast(self.name)
+        return forecast.summarize([self.forecast_hours])[self.forecast_hours]
+
+
+if __name__ == "__main__":
+    # A few locations around the National Mall, mostly in one grid cell
+    fleet = FleetForecast(debug=True)
+    for name, (latitude, longitude) in {"mall": (38.8894, -77.0352),
+                                        "monument": (38.8895, -77.0353),
+                                        "capitol": (38.8899, -77.0091)}.items():
+        fleet.add(name, latitude, longitude)
+
+    print(f"{len(fleet.locations)} locations in {len(fleet)} grids")
+    pprint(fleet.summaries([12]))
+    print(metrics.render())
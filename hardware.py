@@ -0,0 +1,220 @@
+"""Hardware broker: one process which owns the valve and sensor
+
+GPIO pins and the I2C bus should only be claimed by one process. The broker
+creates the Valve and SoilMoistureSensor and serves them over a Unix socket.
+The watering application and every web worker use RemoteValve and
+RemoteSensor, which have the same methods as Valve and SoilMoistureSensor, so
+they all see the same valve state.
+
+Each message is a 4-byte big-endian length followed by that many bytes of
+JSON. A request is {"method": "valve.on", "args": [...]} and the reply is
+{"result": ...} or {"error": "..."}.
+
+Run the broker with "python hardware.py" (see systemd/ogarden-hardware.service)
+and set HARDWARE_SOCKET in .env to the socket path to use it.
+"""
+
+import json
+import os
+import socket
+import socketserver
+import struct
+import threading
+import time
+
+import metrics
+
+HEADER = struct.Struct(">I")
+DEFAULT_SOCKET = "/tmp/ogarden-hardware.sock"
+
+# Methods which are safe to send again if the connection fails before the
+# reply arrives
+IDEMPOTENT = {"valve.off", "valve.status", "valve.remaining", "sensor.measure"}
+
+
+def send(sock, obj):
+    data = json.dumps(obj).encode()
+    sock.sendall(HEADER.pack(len(data)) + data)
+
+
+def receive(sock):
+    """Returns the next message, or None if the connection was closed
+
+    Raises ConnectionError if it closed partway through a message, after
+    which the connection can't be used.
+    """
+    header = receive_exactly(sock, HEADER.size)
+    if header is None:
+        return None
+    data = receive_exactly(sock, HEADER.unpack(header)[0])
+    if data is None:
+        raise ConnectionError("Connection closed partway through a message")
+    return json.loads(data)
+
+
+def receive_exactly(sock, n):
+    data = b""
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+class HardwareBroker(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Serves the methods of a valve and a sensor over a Unix socket
+
+    path:    Path of the Unix socket
+    valve:   ActuatedValve (or Valve)
+    sensor:  SoilMoistureSensor
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path, valve, sensor):
+        self.methods = {"valve.on": valve.on,
+                        "valve.off": valve.off,
+                        "valve.status": valve.status,
+                        "valve.remaining": getattr(valve, "remaining", lambda: 0),
+                        "sensor.measure": sensor.measure,
+                        "metrics.render": lambda: metrics.render(prefix="ogarden_hardware_")}
+        # one lock per device, so a sensor read never waits for the valve
+        self.locks = {"valve": threading.Lock(), "sensor": threading.Lock(),
+                      "metrics": threading.Lock()}
+
+        if os.path.exists(path):
+            os.remove(path)
+        # create the socket with mode 0660 from the start
+        umask = os.umask(0o117)
+        try:
+            super().__init__(path, BrokerHandler)
+        finally:
+            os.umask(umask)
+
+
+    def call(self, method, args):
+        if method not in self.methods:
+            raise ValueError(f"Unknown method {method}")
+        device = method.partition('.')[0]
+        if method == "valve.on" and args and args[0] is not None:
+            # A timed Valve.on() blocks for the duration; don't hold the lock
+            # so that valve.off() and valve.status() still work meanwhile
+            # (an ActuatedValve returns at once)
+            return self.methods[method](*args)
+        with self.locks[device]:
+            return self.methods[method](*args)
+
+
+class BrokerHandler(socketserver.BaseRequestHandler):
+    """Answers requests on one client connection until it closes"""
+
+    def handle(self):
+        while True:
+            try:
+                request = receive(self.request)
+            except ConnectionError:
+                return
+            if request is None:
+                return
+            try:
+                reply = {"result": self.server.call(request["method"],
+                                                    request.get("args", []))}
+            except Exception as e:
+                reply = {"error": f"{type(e).__name__}: {e}"}
+            send(self.request, reply)
+
+
+class HardwareClient:
+    """Persistent, thread-safe connection to the broker"""
+
+    def __init__(self, path=DEFAULT_SOCKET):
+        self.path = path
+        self.lock = threading.Lock()
+        self.sock = None
+
+
+    def call(self, method, *args):
+        with self.lock:
+            # reconnect once if the broker was restarted. A request which may
+            # have reached the broker is only sent again if it is idempotent.
+            for attempt in range(2):
+                sent = False
+                try:
+                    if self.sock is None:
+                        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                        self.sock.connect(self.path)
+                    sent = True
+                    send(self.sock, {"method": method, "args": list(args)})
+                    reply = receive(self.sock)
+                    if reply is None:
+                        raise ConnectionError("Hardware broker closed the connection")
+                    break
+                except (OSError, ValueError):
+                    # the connection is unusable after a failure partway
+                    # through a message
+                    self.sock.close()
+                    self.sock = None
+                    if attempt or (sent and method not in IDEMPOTENT): raise
+
+        if "error" in reply:
+            raise Exception(reply["error"])
+        return reply["result"]
+
+
+class RemoteValve:
+    """Valve served by the hardware broker. Same methods as Valve."""
+
+    def __init__(self, path=DEFAULT_SOCKET):
+        self.client = HardwareClient(path)
+
+    def on(self, duration=None):
+        """Turn the valve on, returning the duration the broker applied"""
+        return self.client.call("valve.on", duration)
+
+    def off(self):
+        self.client.call("valve.off")
+
+    def timer(self, duration):
+        """Water for duration seconds and return when the valve has closed"""
+        duration = self.on(duration=duration)
+        # the broker turns the valve off itself; wait until it has
+        while (remaining := self.remaining()) > 0:
+            time.sleep(min(remaining, 1))
+        return duration
+
+    def status(self):
+        return self.client.call("valve.status")
+
+    def remaining(self):
+        """Seconds until the broker closes the valve, 0 if it is closed"""
+        return self.client.call("valve.remaining")
+
+    def metrics(self):
+        """The broker's valve and I2C metrics, in the Prometheus text format"""
+        return self.client.call("metrics.render")
+
+
+class RemoteSensor:
+    """Sensor served by the hardware broker. Same measure() as SoilMoistureSensor."""
+
+    def __init__(self, path=DEFAULT_SOCKET):
+        self.client = HardwareClient(path)
+
+    def measure(self):
+        return self.client.call("sensor.measure")
+
+
+if __name__ == "__main__":
+    from dotenv import dotenv_values
+    from soil_moisture_sensor import SoilMoistureSensor
+    from actuator import actuated_valve
+
+    config = dotenv_values(".env")
+    path = config.get('HARDWARE_SOCKET', DEFAULT_SOCKET)
+
+    valve = actuated_valve(config.get('VALVE_DEADLINES', 'valve_deadlines.json'),
+                           float(config.get('VALVE_MAX_DURATION', 60*60)))
+    broker = HardwareBroker(path, valve, SoilMoistureSensor(debug=15000))
+    print(f"Serving hardware on {path}")
+    broker.serve_forever()
@@ -0,0 +1,213 @@
+"""Persistent cache for JSON web APIs
+
+Responses are saved to disk with their ETag, Last-Modified and expiry time so
+that later runs of the application can skip the network while the data is
+fresh, and otherwise send a conditional GET which the server can answer with a
+short "304 Not Modified".
+
+Resources which practically never change (such as the NWS points lookup) can
+be cached permanently.
+
+Requests share one keep-alive session. Connection errors, timeouts and server
+errors (5xx) are retried a few times with jittered exponential backoff, all
+within an optional deadline.
+"""
+
+import hashlib
+import json
+import os
+import random
+import time
+from email.utils import parsedate_to_datetime
+
+import requests
+
+import metrics
+
+
+class HttpCache:
+    """On-disk cache of JSON responses, one file per URL
+
+    directory:  Where cached responses are stored
+    headers:    Headers sent with every request (e.g. User-Agent)
+    timeout:    Seconds to wait for the server on each attempt
+    retries:    Number of retries after a failed attempt
+    backoff:    Base delay in seconds before a retry, doubled for each retry
+    debug:      Print whether each request was served from the cache
+    """
+
+    def __init__(self, directory=".http_cache", headers=None,
+                 timeout=10, retries=3, backoff=0.5, debug=False):
+        self.directory = directory
+        self.headers = headers or {}
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.debug = debug
+        os.makedirs(self.directory, exist_ok=True)
+
+        # keep-alive connections are reused between requests
+        self.session = requests.Session()
+
+
+    def get(self, url, permanent=False, deadline=None):
+        """Return the JSON body of url, from the cache when possible
+
+        permanent:  If True, a cached body is always used and never revalidated
+        deadline:   time.monotonic() value by which to give up (raising the
+                    last error), or None to only limit each attempt by timeout
+        """
+        entry = self.load(url)
+
+        if entry and (permanent or time.time() < entry['expires']):
+            if self.debug: print(f"cache hit {url}")
+            metrics.increment("http_cache_total", result="hit")
+            return entry['body']
+
+        headers = dict(self.headers)
+        if entry and entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+
+        r = self.request(url, headers, deadline)
+
+        if r.status_code == 304 and entry:
+            if self.debug: print(f"not modified {url}")
+            metrics.increment("http_cache_total", result="not_modified")
+            entry['expires'] = self.expires(r)
+            self.save(url, entry)
+            return entry['body']
+
+        if self.debug: print(f"fetched {url}")
+        metrics.increment("http_cache_total", result="fetched")
+
+        entry = {'url': url,
+                 'etag': r.headers.get('ETag'),
+                 'last_modified': r.headers.get('Last-Modified'),
+                 'expires': self.expires(r),
+                 'body': r.json()}
+        self.save(url, entry)
+        return entry['body']
+
+
+    def request(self, url, headers, deadline=None):
+        """GET url, retrying errors with jittered exponential backoff"""
+        for attempt in range(self.retries + 1):
+            timeout = self.timeout
+            if deadline is not None:
+                timeout = min(timeout, deadline - time.monotonic())
+                if timeout <= 0:
+                    raise TimeoutError(f"Deadline passed before fetching {url}")
+
+            try:
+                with metrics.timer("http_request"):
+                    r = self.session.get(url, headers=headers, timeout=timeout)
+                # The NWS occasionally answers 500 "Unexpected Problem", which
+                # is worth retrying. Other errors are not.
+                if r.status_code < 500:
+                    if r.status_code != 304:
+                        r.raise_for_status()
+                    return r
+                error = requests.HTTPError(f"{r.status_code} error for {url}", response=r)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+
+            # "full jitter": a random delay up to the exponential backoff
+            delay = random.uniform(0, self.backoff * 2 ** attempt)
+            if attempt == self.retries or \
+               (deadline is not None and time.monotonic() + delay >= deadline):
+                raise error
+            metrics.increment("http_retries_total")
+            if self.debug: print(f"retrying {url} in {delay:.2f}s after {error}")
+            time.sleep(delay)
+
+
+    def last(self, url):
+        """Return the cached body of url however old it is, or None"""
+        entry = self.load(url)
+        return entry and entry['body']
+
+
+    def expires(self, r):
+        """Return the expiry time of response r in seconds since the epoch
+
+        Cache-Control max-age takes priority over the Expires header, as in
+        HTTP. Responses without either expire immediately, which means they
+        are always revalidated with a conditional GET.
+        """
+        for directive in r.headers.get('Cache-Control', '').split(','):
+            name, _, value = directive.strip().partition('=')
+            if name == 'max-age' and value.isdigit():
+                return time.time() + int(value) - int(r.headers.get('Age', 0))
+
+        if 'Expires' in r.headers:
+            try:
+                return parsedate_to_datetime(r.headers['Expires']).timestamp()
+            except (TypeError, ValueError):
+                pass
+
+        return 0
+
+
+    def path(self, url):
+        name = hashlib.sha1(url.encode()).hexdigest() + ".json"
+        return os.path.join(self.directory, name)
+
+
+    def load(self, url):
+        try:
+            with open(self.path(url)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+
+    def save(self, url, entry):
+        # Write to a temporary file and rename, so an interrupted write never
+        # leaves a corrupt cache entry behind
+        path = self.path(url)
+        with open(path + ".tmp", 'w') as f:
+            json.dump(entry, f)
+        os.replace(path + ".tmp", path)
+
+
+if __name__ == "__main__":
+    # Self-test against a local stand-in server
+    import tempfile
+    import threading
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+    hits = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            hits.append(self.path)
+            if self.headers.get('If-None-Match') == '"v1"':
+                self.send_response(304)
+                self.end_headers()
+                return
+            body = json.dumps({'path': self.path}).encode()
+            self.send_response(200)
+            self.send_header('ETag', '"v1"')
+            self.send_header('Cache-Control', 'max-age=1')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}"
+
+    cache = HttpCache(tempfile.mkdtemp(), debug=True)
+    cache.get(url + "/points", permanent=True)
+    cache.get(url + "/points", permanent=True)
+    cache.get(url + "/forecast")
+    cache.get(url + "/forecast")
+    time.sleep(1.1)
+    print(cache.get(url + "/forecast"))
+    print(f"server requests: {hits}")
+    server.shutdown()
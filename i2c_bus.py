@@ -0,0 +1,226 @@
+"""Shared I2C bus for many soil moisture sensors
+
+One I2CBus owns the single SMBus handle of a port. Sensors registered on it
+share that handle, and every transaction takes the bus lock, so readers on
+different threads never collide.
+
+sweep() reads all registered sensors in one pass, taking the bus lock once
+for the whole pass. The reads run on a worker thread, so a read which takes
+longer than timeout is abandoned rather than stalling the sweep: it counts as
+a timeout, the rest of the sweep is reported "busy", and so are later sweeps
+until the hung read returns. Errors and timeouts are counted per sensor. A
+sensor which keeps failing is skipped for a growing number of sweeps (up to
+max_backoff), so a dead probe doesn't slow down the rest of the garden.
+
+start() sweeps on a schedule in a background thread; latest() returns the
+readings of the last sweep.
+
+The application itself reads a single sensor, so it doesn't use I2CBus. It is
+for gardens with several probes on one port.
+
+Usage:
+    bus = I2CBus.open(port=1)
+    bus.register(0x10, dry=11000, wet=22000)
+    bus.register(0x11, dry=10500, wet=21000)
+    readings = bus.sweep()
+"""
+
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep
+
+import smbus2
+
+from soil_moisture_sensor import SoilMoistureSensor
+
+
+class Probe:
+    """Health of one sensor address on the bus"""
+
+    def __init__(self, sensor):
+        self.sensor = sensor
+        self.reads = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.consecutive_errors = 0
+        self.skip = 0           # sweeps left to skip
+        self.last_duration = 0
+
+
+class I2CBus:
+    """Shared SMBus handle and lock for one I2C port
+
+    port:         Which SMBus/I2C port to access
+    timeout:      Seconds a read may take before it is abandoned
+    max_backoff:  Most sweeps a failing sensor is skipped for
+    """
+
+    buses = {}
+    buses_lock = threading.Lock()
+
+    @classmethod
+    def open(cls, port=1, **kwargs):
+        """Return the shared I2CBus of port, creating it on first use"""
+        with cls.buses_lock:
+            if port not in cls.buses:
+                cls.buses[port] = cls(port, **kwargs)
+            return cls.buses[port]
+
+
+    def __init__(self, port=1, timeout=0.05, max_backoff=64):
+        self.port = port
+        self.timeout = timeout
+        self.max_backoff = max_backoff
+        # reentrant, so a sweep can hold it while its sensors read
+        self.lock = threading.RLock()
+        self.probes = {}
+
+        # the thread which performs sweeps, and the sweep it is performing
+        self.worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix="i2c")
+        self.pending = None
+        self.readings = {}
+        self.stopped = threading.Event()
+        self.thread = None
+
+        self.bus = smbus2.SMBus(port)
+        sleep(0.1) # this resolves a race condition when immediately measuring
+
+
+    def read_i2c_block_data(self, address, offset, length):
+        """Same as SMBus.read_i2c_block_data, holding the bus lock"""
+        with self.lock:
+            return self.bus.read_i2c_block_data(address, offset, length)
+
+
+    def register(self, address, dry=11000, wet=22000, debug=None):
+        """Add a sensor at address with its dry/wet calibration"""
+        sensor = SoilMoistureSensor(address=address, port=self.port,
+                                    dry=dry, wet=wet, debug=debug, bus=self)
+        self.probes[address] = Probe(sensor)
+        return sensor
+
+
+    def sweep(self):
+        """Read every registered sensor once
+
+        Returns a dictionary of address to reading. A reading holds
+        "sensor_value" (None if the read failed or the sensor was not read)
+        and "error" (None, "error", "timeout", "skipped" or "busy").
+        """
+        if self.pending is not None and not self.pending.done():
+            # a read of an earlier sweep is still hung, holding the bus
+            self.readings = {address: {"sensor_value": None, "error": "busy"}
+                             for address in self.probes}
+            return self.readings
+
+        readings = {}
+        due = []
+        for address, probe in self.probes.items():
+            if probe.skip:
+                probe.skip -= 1
+                readings[address] = {"sensor_value": None, "error": "skipped"}
+            else:
+                due.append(address)
+
+        results = queue.Queue()
+        cancelled = threading.Event()
+        self.pending = self.worker.submit(self.read, [self.probes[a] for a in due],
+                                          results, cancelled)
+
+        for i, address in enumerate(due):
+            probe = self.probes[address]
+            probe.reads += 1
+            try:
+                value, error, probe.last_duration = results.get(timeout=self.timeout)
+            except queue.Empty:
+                cancelled.set()
+                value, error, probe.last_duration = None, "timeout", self.timeout
+
+            if error is None:
+                probe.consecutive_errors = 0
+            else:
+                if error == "timeout":
+                    probe.timeouts += 1
+                else:
+                    probe.errors += 1
+                probe.consecutive_errors += 1
+                # skip 1, 2, 4, ... sweeps after consecutive failures
+                probe.skip = min(2 ** (probe.consecutive_errors - 1), self.max_backoff)
+
+            readings[address] = {"sensor_value": value, "error": error}
+            if cancelled.is_set():
+                # the hung read holds the bus, so the rest can't be read
+                for rest in due[i+1:]:
+                    readings[rest] = {"sensor_value": None, "error": "busy"}
+                break
+
+        self.readings = readings
+        return readings
+
+
+    def read(self, probes, results, cancelled):
+        """Read probes in order under one hold of the bus lock, putting
+        (value, error, duration) of each into results. Runs on the worker.
+        """
+        with self.lock:
+            for probe in probes:
+                if cancelled.is_set():
+                    return
+                start = time.monotonic()
+                try:
+                    value, error = probe.sensor.measure()["sensor_value"], None
+                except Exception:
+                    value, error = None, "error"
+                results.put((value, error, time.monotonic() - start))
+
+
+    def start(self, interval=60):
+        """Sweep every interval seconds in a daemon thread. Returns self."""
+        def run():
+            due = time.monotonic()
+            while not self.stopped.is_set():
+                self.sweep()
+                due += interval
+                self.stopped.wait(max(0, due - time.monotonic()))
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+        return self
+
+
+    def latest(self):
+        """Return the readings of the last sweep"""
+        return self.readings
+
+
+    def health(self):
+        """Returns the read, error and timeout counts of every sensor"""
+        return {address: {"reads": p.reads,
+                          "errors": p.errors,
+                          "timeouts": p.timeouts,
+                          "consecutive_errors": p.consecutive_errors,
+                          "last_duration": round(p.last_duration, 4)}
+                for address, p in self.probes.items()}
+
+
+    def close(self):
+        self.stopped.set()
+        if self.thread: self.thread.join()
+        self.worker.shutdown(wait=False)
+        self.bus.close()
+        with I2CBus.buses_lock:
+            I2CBus.buses.pop(self.port, None)
+
+
+if __name__ == "__main__":
+    from pprint import pprint
+
+    # Debug values stand in for sensors which aren't connected
+    bus = I2CBus.open(port=1)
+    for i, address in enumerate(range(0x10, 0x14)):
+        bus.register(address, debug=12000 + 2000*i)
+
+    for _ in range(3):
+        pprint(bus.sweep())
+    pprint(bus.health())
@@ -1,6 +1,8 @@
 """
 
 """
+import numpy as np
+
 
 class IrrigationModel:
     """Irrigation model class
@@ -59,6 +61,7 @@ class IrrigationModel:
         """Convert millimeters of rainfall (uniform depth of water) to seconds of irrigation
            Inputs: 
                mm - millimeters of rainfall (uniform depth of water to be applied)
+                    as a number or a NumPy array
 
            Returns:
                Number of seconds to activate the irrigation system
@@ -67,7 +70,8 @@ class IrrigationModel:
         #   depth (m)  x area (m^2)              x Liters/m^3  / Liters/second    [final units are seconds]
         t = (mm/1000)  * self.area_square_meters * 1000        / self.flow_rate_liters_per_second
 
-        return round(t, 1)
+        # NumPy arrays are rounded elementwise
+        return round(t, 1) if np.ndim(t) == 0 else np.round(t, 1)
 
 
 # Example usage
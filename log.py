@@ -1,15 +1,121 @@
+"""Log database for watering sessions
+
+Records are stored in SQLite with an index on the record timestamp, so
+retention is a single range delete and reading the newest records only touches
+the rows that are returned.
+
+Daily and weekly rollups (count, sum, min and max of every numeric field) are
+updated as records are added, and are kept when old records are deleted, so
+long-term charts never have to be recomputed from the records.
+
+Records removed from the log are moved to an Archive of compressed monthly
+segments next to the database (see archive.py). history() reads the archive
+and the log together.
+
+Older versions of Ogarden kept the log in a TinyDB JSON file. Opening such a
+file migrates its records into SQLite, and the original JSON is kept next to
+it with a ".tinydb" suffix.
 """
-"""
+import json
+import os
+import sqlite3
+import threading
 from datetime import datetime, timedelta
-from tinydb import TinyDB, Query
+
+import metrics
+from archive import Archive
+
+SQLITE_HEADER = b"SQLite format 3\x00"
+
+ROLLUP_PERIODS = ("day", "week")
 
 
 class Log:
-    """Creates and uses a database for log persistence 
+    """Creates and uses a database for log persistence
+
+    file:         Path of the database file
+    max_records:  Number of records to keep
+    max_days:     Age in days after which records are archived
+    archive:      Directory of the archive of removed records, defaults to
+                  file + ".archive". False to delete them instead.
+    batch:        Fewest records removed at a time. Adding a record to the
+                  archive rewrites its month's segment, so records are only
+                  archived once at least this many are due.
     """
 
-    def __init__(self, file):
-        self.db = TinyDB(file)
+    def __init__(self, file, max_records=1000, max_days=365, archive=None, batch=50):
+        self.file = file
+        self.max_records = max_records
+        self.max_days = max_days
+        self.batch = batch
+        if archive is False:
+            self.archive = None
+        else:
+            self.archive = Archive(archive or file + ".archive")
+
+        records = self.migrate()
+
+        # The web API reads from several threads, so share the connection
+        # and serialize access with a lock
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(file, check_same_thread=False)
+        with self.lock, self.db:
+            # write-ahead logging lets the web API read while a session writes
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS log ("
+                            "id INTEGER PRIMARY KEY, "
+                            "isodatetime TEXT NOT NULL, "
+                            "record TEXT NOT NULL)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS log_isodatetime "
+                            "ON log (isodatetime)")
+            self.db.executemany("INSERT INTO log (isodatetime, record) "
+                                "VALUES (?, ?)",
+                                [(r['isodatetime'], json.dumps(r))
+                                 for r in records])
+
+            new_rollups = self.db.execute(
+                "SELECT COUNT(*) FROM sqlite_master WHERE name = 'rollup'").fetchone()[0] == 0
+            self.db.execute("CREATE TABLE IF NOT EXISTS rollup ("
+                            "period TEXT NOT NULL, "
+                            "start TEXT NOT NULL, "
+                            "field TEXT NOT NULL, "
+                            "count INTEGER NOT NULL, "
+                            "total REAL NOT NULL, "
+                            "min REAL NOT NULL, "
+                            "max REAL NOT NULL, "
+                            "PRIMARY KEY (period, start, field))")
+            if new_rollups:
+                # first use of rollups with an existing log
+                for row in self.db.execute("SELECT record FROM log").fetchall():
+                    self.update_rollups(json.loads(row[0]))
+
+        if records:
+            self.clean()
+
+
+    def migrate(self):
+        """Read the records of a TinyDB log file, if that is what file is.
+
+        The TinyDB file is renamed so SQLite can take its place. Returns the
+        records to be inserted, or an empty list if there is nothing to do.
+        """
+        if not os.path.exists(self.file) or os.path.getsize(self.file) == 0:
+            return []
+
+        with open(self.file, 'rb') as f:
+            if f.read(len(SQLITE_HEADER)) == SQLITE_HEADER:
+                return []
+
+        from tinydb import TinyDB
+
+        db = TinyDB(self.file)
+        records = [dict(r) for r in db.all() if 'isodatetime' in r]
+        db.close()
+
+        backup = self.file + ".tinydb"
+        os.replace(self.file, backup)
+        print(f"migrated {len(records)} records from TinyDB (kept {backup})")
+        return records
 
 
     def add(self, obj):
@@ -18,41 +124,254 @@ class Log:
         # add a timestamp
         obj["isodatetime"] = datetime.isoformat(datetime.now())
 
-        self.db.insert(obj)
+        with metrics.timer("log_write"):
+            with self.lock, self.db:
+                self.db.execute("INSERT INTO log (isodatetime, record) VALUES (?, ?)",
+                                (obj["isodatetime"], json.dumps(obj)))
+                self.update_rollups(obj)
+
+            self.clean()
+
 
-        self.clean()
+    def update_rollups(self, obj):
+        """Add the numeric fields of obj to the day and week it belongs to"""
+        day = datetime.fromisoformat(obj['isodatetime']).date()
+        starts = {"day": day.isoformat(),
+                  "week": (day - timedelta(days=day.weekday())).isoformat()}
+
+        rows = [(period, starts[period], field, value, value, value)
+                for period in ROLLUP_PERIODS
+                for field, value in obj.items()
+                if isinstance(value, (int, float)) and not isinstance(value, bool)]
+
+        self.db.executemany("INSERT INTO rollup VALUES (?, ?, ?, 1, ?, ?, ?) "
+                            "ON CONFLICT (period, start, field) DO UPDATE SET "
+                            "count = count + 1, "
+                            "total = total + excluded.total, "
+                            "min = MIN(min, excluded.min), "
+                            "max = MAX(max, excluded.max)", rows)
 
 
     def clean(self):
-        """Keep only 1000 records from the last year. Delete others.
+        """Keep only 1000 records from the last year. Archive others.
+
+        ISO 8601 timestamps sort in time order, so both limits reduce to one
+        cutoff on the index and a single range delete. Nothing is removed
+        until at least batch records are due, so the log may briefly hold up
+        to max_records + batch - 1 records, or records a little older than
+        max_days. Records are written to the archive before they are deleted,
+        so an interruption can't lose them (the archive ignores records it
+        already has).
         """
+        cutoff = datetime.isoformat(datetime.now() - timedelta(days=self.max_days))
+
+        with self.lock, self.db:
+            # newest record beyond the record limit, if there is one. Records
+            # may share its timestamp, so ties are broken on the id, as in
+            # page().
+            row = self.db.execute("SELECT isodatetime, id FROM log "
+                                  "ORDER BY isodatetime DESC, id DESC LIMIT 1 OFFSET ?",
+                                  (self.max_records,)).fetchone()
+            if row is None:
+                where, args = "isodatetime < ?", (cutoff,)
+            else:
+                where = "isodatetime < ? OR isodatetime < ? OR (isodatetime = ? AND id <= ?)"
+                args = (cutoff, row[0], row[0], row[1])
 
-        def older_than_days(d_isoformat, days):
-            d = datetime.fromisoformat(d_isoformat)
-            age = timedelta(days=days)
-            now = datetime.now()
-            return d < (now - age)
+            due = self.db.execute("SELECT COUNT(*) FROM log WHERE " + where, args).fetchone()[0]
+            if due < self.batch:
+                return
 
-        self.db.remove(Query().isodatetime.test(older_than_days, 365))
+            if self.archive is not None:
+                # with their ids, since records may share a timestamp
+                rows = self.db.execute("SELECT id, record FROM log WHERE " + where, args).fetchall()
+                self.archive.add([{**json.loads(record), "id": id} for id, record in rows])
 
-        max_length = 1000
-        if len(self.db) > max_length:
-            # sort in reverse order (oldest first)
-            sorted_records = sorted(self.db.all(), 
-                                    key=lambda k: k['isodatetime'],
-                                    reverse=True)
-            for r in sorted_records[max_length:]:
-                self.db.remove(Query().isodatetime == r['isodatetime'])
-                print(f"removed {r['isodatetime']}")
+            removed = self.db.execute("DELETE FROM log WHERE " + where, args).rowcount
+
+        if removed:
+            print(f"{'archived' if self.archive else 'removed'} {removed} records")
 
 
     def tail(self, n=1000):
         """Return the last n log entries
         """
-        # sort in forward order (newest first)
-        sorted_records = sorted(self.db.all(),
-                                key=lambda k: k['isodatetime'])
-        return sorted_records[-n::]
+        return self.range(limit=n)
+
+
+    def range(self, since=None, until=None, limit=None):
+        """Return log entries from since (inclusive) to until (exclusive)
+
+        since, until:  ISO 8601 strings, or None for no bound
+        limit:         If given, only the newest limit entries in the range
+
+        Entries are returned in time order (oldest first).
+        """
+        return self.page(since=since, until=until, limit=limit)[0]
+
+
+    def page(self, since=None, until=None, before=None, limit=None):
+        """Return a page of log entries, and the position of the next page
+
+        since, until:  ISO 8601 strings, or None for no bound
+        before:        Position returned for the previous page, to continue
+                       with older entries
+        limit:         If given, only the newest limit entries
+
+        Returns the entries in time order (oldest first), and the position
+        (isodatetime, id) of the oldest one if the page is full, else None.
+        Entries with the same timestamp are ordered by id, so a position
+        never skips or repeats any of them.
+        """
+        where, args = [], []
+        if since is not None:
+            where.append("isodatetime >= ?")
+            args.append(since)
+        if until is not None:
+            where.append("isodatetime < ?")
+            args.append(until)
+        if before is not None:
+            where.append("(isodatetime < ? OR (isodatetime = ? AND id < ?))")
+            args.extend([before[0], before[0], before[1]])
+
+        sql = "SELECT id, isodatetime, record FROM log"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY isodatetime DESC, id DESC"
+        if limit is not None:
+            sql += " LIMIT ?"
+            args.append(limit)
+
+        with self.lock:
+            rows = self.db.execute(sql, args).fetchall()
+
+        full = rows and limit is not None and len(rows) == limit
+        position = (rows[-1][1], rows[-1][0]) if full else None
+        return [json.loads(r[2]) for r in reversed(rows)], position
+
+
+    def series(self, fields, since=None, until=None):
+        """Return fields of the entries in a range as columns
+
+        Returns a dictionary with a list of "isodatetime" values and a list
+        for each field (None where an entry doesn't have the field).
+
+        Only the requested fields are extracted from each record, by SQLite.
+        """
+        for field in fields:
+            if not field.isidentifier():
+                raise ValueError(f"Invalid field name {field!r}")
+
+        # the value and JSON type of each field, so booleans, lists and
+        # objects come back as they were logged
+        paths = [f'$."{field}"' for field in fields]
+        sql = "SELECT isodatetime" + \
+              "".join(", json_extract(record, ?), json_type(record, ?)" for _ in fields) + \
+              " FROM log"
+        args = [p for path in paths for p in (path, path)]
+        where = []
+        if since is not None:
+            where.append("isodatetime >= ?")
+            args.append(since)
+        if until is not None:
+            where.append("isodatetime < ?")
+            args.append(until)
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY isodatetime, id"
+
+        with self.lock:
+            rows = self.db.execute(sql, args).fetchall()
+
+        columns = {"isodatetime": [r[0] for r in rows]}
+        for i, field in enumerate(fields):
+            columns[field] = [decode(r[1 + 2*i], r[2 + 2*i]) for r in rows]
+        return columns
+
+
+    def history(self, fields, since=None, until=None):
+        """Like series(), but including archived entries"""
+        if self.archive is None:
+            return self.series(fields, since=since, until=until)
+
+        # the archive only has entries older than the log's oldest
+        with self.lock:
+            oldest = self.db.execute("SELECT MIN(isodatetime) FROM log").fetchone()[0]
+        if oldest is not None and (until is None or oldest < until):
+            archived = self.archive.query(fields, since=since, until=oldest)
+        else:
+            archived = self.archive.query(fields, since=since, until=until)
+        recent = self.series(fields, since=since, until=until)
+        return {k: archived[k] + recent[k] for k in recent}
+
+
+    def rollups(self, period, fields, since=None, until=None):
+        """Return the day or week rollups of fields as columns
+
+        period:        "day" or "week"
+        since, until:  ISO 8601 dates of the first and after the last period
+
+        Returns a dictionary with a list of period "start" dates, and for each
+        field a dictionary of "count", "sum", "mean", "min" and "max" lists
+        (None in periods without the field).
+        """
+        if period not in ROLLUP_PERIODS:
+            raise ValueError(f"period must be one of {ROLLUP_PERIODS}")
+
+        placeholders = ", ".join("?" * len(fields))
+        sql = "SELECT start, field, count, total, min, max FROM rollup " \
+              f"WHERE period = ? AND field IN ({placeholders})"
+        args = [period, *fields]
+        if since is not None:
+            sql += " AND start >= ?"
+            args.append(since)
+        if until is not None:
+            sql += " AND start < ?"
+            args.append(until)
+
+        with self.lock:
+            rows = self.db.execute(sql + " ORDER BY start", args).fetchall()
+
+        starts = sorted({r[0] for r in rows})
+        index = {start: i for i, start in enumerate(starts)}
+        columns = {"start": starts}
+        for field in fields:
+            columns[field] = {stat: [None] * len(starts)
+                              for stat in ("count", "sum", "mean", "min", "max")}
+        for start, field, count, total, low, high in rows:
+            i = index[start]
+            c = columns[field]
+            c["count"][i], c["sum"][i], c["min"][i], c["max"][i] = count, total, low, high
+            c["mean"][i] = total / count
+        return columns
+
+
+    def newest(self):
+        """Return the timestamp of the newest entry, or None if empty"""
+        with self.lock:
+            row = self.db.execute("SELECT MAX(isodatetime) FROM log").fetchone()
+        return row[0]
+
+
+    def version(self):
+        """Return a string which changes whenever entries are added or removed"""
+        with self.lock:
+            row = self.db.execute("SELECT MAX(isodatetime), COUNT(*), MIN(id) FROM log").fetchone()
+        return "|".join(map(str, row))
+
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM log").fetchone()[0]
+
+
+def decode(value, kind):
+    """Convert a value from json_extract() back to what json.loads() gives"""
+    if kind in ("true", "false"):
+        return kind == "true"
+    if kind in ("object", "array"):
+        return json.loads(value)
+    return value
 
 
 if __name__ == "__main__":
@@ -60,5 +379,4 @@ if __name__ == "__main__":
 
     log = Log("log.db")
     #log.add({"testobject": True})
-    pprint(log.db.all())
-
+    pprint(log.tail())
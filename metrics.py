@@ -0,0 +1,152 @@
+"""Lightweight metrics: stage timings, latency histograms and counters
+
+Recording a metric only updates a few numbers in memory. Text in the
+Prometheus exposition format is built only when someone asks for it, so
+instrumentation costs next to nothing when no one is scraping.
+
+Usage:
+    import metrics
+
+    with metrics.span("weather_fetch"):     # duration of a session stage
+        ...
+    metrics.observe("http_request", 0.42)   # latency histogram
+    metrics.increment("errors", kind="i2c") # counter
+
+The watering application runs in its own process, so it saves its metrics to
+a file with save() after each session; the web API serves its own metrics
+together with that file at /metrics. The hardware broker's metrics (valve and
+I2C) are fetched from it over its socket. Each process uses its own prefix so
+the names never clash.
+"""
+
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Histogram bucket upper bounds in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, float("inf"))
+
+PREFIX = "ogarden_"
+
+lock = threading.Lock()
+counters = {}    # (name, labels) -> value
+gauges = {}      # (name, labels) -> value
+histograms = {}  # (name, labels) -> [bucket counts, sum, count]
+
+
+def key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def increment(name, amount=1, **labels):
+    """Add amount to a counter"""
+    k = key(name, labels)
+    with lock:
+        counters[k] = counters.get(k, 0) + amount
+
+
+def set_gauge(name, value, **labels):
+    """Set a gauge to value"""
+    with lock:
+        gauges[key(name, labels)] = value
+
+
+def observe(name, seconds, **labels):
+    """Add a duration to a histogram"""
+    k = key(name, labels)
+    with lock:
+        h = histograms.get(k)
+        if h is None:
+            h = histograms[k] = [[0] * len(BUCKETS), 0.0, 0]
+        h[0][bisect.bisect_left(BUCKETS, seconds)] += 1
+        h[1] += seconds
+        h[2] += 1
+
+
+@contextmanager
+def timer(name, **labels):
+    """Observe the duration of a block in a histogram. Errors are counted."""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        increment("errors_total", source=name)
+        raise
+    finally:
+        observe(name + "_seconds", time.perf_counter() - start, **labels)
+
+
+@contextmanager
+def span(stage):
+    """Time one stage of a watering session
+
+    The duration of the latest run of each stage is kept as a gauge, and
+    every run is added to the stage histogram.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        increment("errors_total", source=stage)
+        raise
+    finally:
+        record_stage(stage, time.perf_counter() - start)
+
+
+def record_stage(stage, duration):
+    """Record the duration of a stage timed some other way than span()"""
+    set_gauge("stage_last_seconds", duration, stage=stage)
+    observe("stage_seconds", duration, stage=stage)
+
+
+def format_labels(labels, extra=()):
+    labels = list(labels) + list(extra)
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+def render(prefix=PREFIX):
+    """Return all metrics in the Prometheus text exposition format"""
+    lines = []
+    with lock:
+        for kind, metrics in (("counter", counters), ("gauge", gauges)):
+            for name in sorted({n for n, _ in metrics}):
+                lines.append(f"# TYPE {prefix}{name} {kind}")
+                for (n, labels), value in sorted(metrics.items()):
+                    if n == name:
+                        lines.append(f"{prefix}{name}{format_labels(labels)} {value}")
+
+        for name in sorted({n for n, _ in histograms}):
+            lines.append(f"# TYPE {prefix}{name} histogram")
+            for (n, labels), (buckets, total, count) in sorted(histograms.items()):
+                if n != name:
+                    continue
+                cumulative = 0
+                for bound, c in zip(BUCKETS, buckets):
+                    cumulative += c
+                    le = "+Inf" if bound == float("inf") else str(bound)
+                    lines.append(f"{prefix}{name}_bucket"
+                                 f"{format_labels(labels, [('le', le)])} {cumulative}")
+                lines.append(f"{prefix}{name}_sum{format_labels(labels)} {total}")
+                lines.append(f"{prefix}{name}_count{format_labels(labels)} {count}")
+
+    return "\n".join(lines) + "\n"
+
+
+def save(file, prefix=PREFIX):
+    """Write the metrics to file, replacing it atomically"""
+    with open(file + ".tmp", 'w') as f:
+        f.write(render(prefix))
+    os.replace(file + ".tmp", file)
+
+
+if __name__ == "__main__":
+    with span("example"):
+        time.sleep(0.01)
+    with timer("http_request", host="example.com"):
+        pass
+    increment("valve_on_seconds_total", 12.5)
+    print(render())
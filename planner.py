@@ -0,0 +1,176 @@
+"""Watering plan for every scheduled session in the forecast
+
+The NWS gridpoint forecast covers about a week, but a session only uses the
+next forecast_hours of it. The planner summarizes the forecast for every
+scheduled session up to the end of the forecast in one vectorized pass, and
+projects the water amount and valve duration of each (with the soil at
+SENSOR_NOMINAL, since the sensor can't be known in advance).
+
+The plan is saved to a file and reused, by later sessions and the web API,
+until the NWS publishes a newer forecast. The grid is rechecked at most every
+refresh seconds. A session then only looks up its forecast summary in the
+plan and corrects the water amount with its own sensor reading, by running
+soil.calculate() as usual.
+
+The NWS updates gridpoint forecasts about every hour, while sessions are
+usually 12 hours apart. So a session normally finds a newer forecast and
+downloads the grid and replans anyway (replanning takes milliseconds): the
+plan saves the download only for sessions within refresh of the last check
+or before the next NWS update, such as a restarted daemon catching up. Its
+main use is the week's projected sessions served at /api/plan.
+
+Usage:
+    planner = Planner(weather, irrigation, Schedule("06:00,18:00"))
+    conditions = planner.forecast()   # like weather.fetch()
+    planner.sessions()                # the week's plan
+"""
+
+import json
+import os
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+import soil
+from scheduler import Schedule
+from weather import Forecast
+
+
+class Planner:
+    """Plans the scheduled sessions from one forecast download
+
+    weather:     NationalWeatherService
+    irrigation:  IrrigationModel
+    schedule:    Schedule of the sessions, or its times as a string
+    file:        Where the plan is saved
+    refresh:     Seconds between checks for a newer forecast
+    tolerance:   Seconds a session may be late and still use its plan entry
+    """
+
+    def __init__(self, weather, irrigation, schedule, file="plan.json",
+                 refresh=60*60, tolerance=30*60):
+        self.weather = weather
+        self.irrigation = irrigation
+        self.schedule = Schedule(schedule) if isinstance(schedule, str) else schedule
+        self.file = file
+        self.refresh = refresh
+        self.tolerance = tolerance
+        self.plan = load(file)
+
+
+    def update(self, deadline=None, now=None):
+        """Recheck the forecast if refresh has passed, replanning if it is new
+
+        Returns the plan.
+        """
+        if self.plan and time.time() - self.plan['checked'] < self.refresh:
+            return self.plan
+
+        grid = self.weather.grid(deadline)
+        updated = grid['properties'].get('updateTime')
+        if self.plan and updated is not None and updated == self.plan['updated']:
+            self.plan['checked'] = time.time()
+        else:
+            self.plan = self.make(Forecast(grid), now)
+        save(self.plan, self.file)
+        return self.plan
+
+
+    def make(self, forecast, now=None):
+        """Plan every scheduled session from now to the end of the forecast"""
+        now = now or datetime.now()
+        end = datetime.fromtimestamp(forecast.end())
+        hours = self.weather.forecast_hours
+
+        times = []
+        t = self.schedule.next(now - timedelta(seconds=self.tolerance))
+        while t < end:
+            times.append(t)
+            t = self.schedule.next(t)
+
+        starts = np.array([t.timestamp() for t in times])
+        conditions = forecast.summarize_windows(starts, starts + hours * 60 * 60)
+        conditions = {key: np.round(values, 2) for key, values in conditions.items()}
+
+        water = soil.calculate_batch(**conditions,
+                                     now=np.array(times, dtype='datetime64[us]'))
+        duration = self.irrigation.millimeters_to_seconds(water)
+
+        sessions = []
+        for i, t in enumerate(times):
+            sessions.append({"time": t.isoformat(),
+                             **{key: float(values[i]) for key, values in conditions.items()},
+                             "water_amount": float(water[i]),
+                             "valve_duration": float(duration[i])})
+
+        return {"updated": forecast.updated,
+                "checked": time.time(),
+                "forecast_hours": hours,
+                "sessions": sessions}
+
+
+    def forecast(self, deadline=None, now=None):
+        """Return the forecast summary for a session now, like weather.fetch()
+
+        Uses the plan entry of the scheduled session now belongs to. Sessions
+        at unscheduled times are summarized from the forecast directly.
+        """
+        now = now or datetime.now()
+        plan = self.update(deadline, now)
+        for session in plan['sessions']:
+            delay = (now - datetime.fromisoformat(session['time'])).total_seconds()
+            if 0 <= delay <= self.tolerance:
+                return {key: session[key] for key in conditions(session)}
+
+        return self.weather.fetch(deadline)
+
+
+    def last_forecast(self):
+        return self.weather.last_forecast()
+
+
+    def sessions(self, since=None):
+        """Return the planned sessions from since (default now) onwards"""
+        since = (since or datetime.now()).isoformat()
+        plan = self.plan or {"sessions": []}
+        return [s for s in plan['sessions'] if s['time'] >= since]
+
+
+def conditions(session):
+    return [key for key in session if key not in ("time", "water_amount", "valve_duration")]
+
+
+def load(file):
+    """Return the plan saved in file, or None"""
+    try:
+        with open(file) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save(plan, file):
+    with open(file + ".tmp", 'w') as f:
+        json.dump(plan, f)
+    os.replace(file + ".tmp", file)
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    from dotenv import dotenv_values
+    from irrigation_model import IrrigationModel
+    from weather import NationalWeatherService
+
+    soil.DEBUG = False
+    config = dotenv_values(".env")
+    weather = NationalWeatherService(latitude=config.get('LATITUDE', 38.8894),
+                                     longitude=config.get('LONGITUDE', -77.0352),
+                                     user_agent=config.get('USER_AGENT', "ogarden planner demo"))
+    irrigation = IrrigationModel(us_gallons=40.3, seconds=60*60, area_square_feet=70)
+    planner = Planner(weather, irrigation, config.get('SCHEDULE', "06:00,18:00"),
+                      file=os.path.join(tempfile.mkdtemp(), "plan.json"))
+    planner.update()
+    for s in planner.sessions():
+        print(f"{s['time']:26} {s['water_amount']:6.2f} mm {s['valve_duration']:8.1f} s")
@@ -0,0 +1,137 @@
+"""Replay logged watering sessions under alternative model parameters
+
+Every log record holds the conditions of a watering session along with the
+water amount and valve duration that were applied. Replaying re-runs those
+conditions through the soil and irrigation models with different parameters,
+and compares the result with what was logged. Season start and "now" are
+taken from each record's timestamp.
+
+Usage:
+    python replay.py --set SENSOR_K=0.5 --sweep TEMPERATURE_K=0.2,0.4,0.6
+
+--set fixes a parameter for every replay, and --sweep replays each of the
+listed values (several sweeps are combined in every combination). Large sweeps
+are spread across a process pool.
+"""
+
+import argparse
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import soil
+from irrigation_model import IrrigationModel
+from log import Log
+
+CONDITIONS = ["ave_probability_of_precipitation",
+              "ave_relative_humidity",
+              "ave_sky_cover",
+              "ave_temperature",
+              "ave_wind_gust",
+              "ave_wind_speed",
+              "total_precipitation",
+              "sensor_value"]
+
+
+def load(records):
+    """Return condition arrays and logged results from log records"""
+    records = [r for r in records
+               if 'water_amount' in r and all(c in r for c in CONDITIONS)]
+
+    conditions = {c: np.array([r[c] for r in records], dtype=float)
+                  for c in CONDITIONS}
+    conditions['now'] = np.array([r['isodatetime'] for r in records],
+                                 dtype='datetime64[us]')
+    logged = {'water': np.array([r['water_amount'] for r in records], dtype=float),
+              'seconds': np.array([r['valve_duration'] for r in records], dtype=float)}
+    return conditions, logged
+
+
+def replay(conditions, irrigation, parameter_sets):
+    """Replay the conditions once for each dictionary in parameter_sets
+
+    All parameter sets are evaluated in one vectorized call, one row per set.
+    Returns arrays of water amounts and valve durations, both shaped
+    (len(parameter_sets), sessions).
+    """
+    names = {name for p in parameter_sets for name in p}
+    defaults = soil.parameters()
+    params = {name: np.array([p.get(name, defaults[name]) for p in parameter_sets])[:, None]
+              for name in names}
+
+    water = soil.calculate_batch(**conditions, params=params)
+    water = np.broadcast_to(water, (len(parameter_sets), len(conditions['now'])))
+    return water, irrigation.millimeters_to_seconds(water)
+
+
+def replay_parallel(conditions, irrigation, parameter_sets, workers=None, chunk=64):
+    """Replay many parameter sets, spread across a process pool in chunks"""
+    chunks = [parameter_sets[i:i + chunk] for i in range(0, len(parameter_sets), chunk)]
+    if len(chunks) == 1:
+        return replay(conditions, irrigation, parameter_sets)
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(replay,
+                                itertools.repeat(conditions),
+                                itertools.repeat(irrigation),
+                                chunks))
+    return (np.concatenate([w for w, s in results]),
+            np.concatenate([s for w, s in results]))
+
+
+def parameter_sets(fixed, sweeps):
+    """Return the parameter dictionaries for every combination of sweeps"""
+    names = list(sweeps)
+    return [{**fixed, **dict(zip(names, values))}
+            for values in itertools.product(*sweeps.values())]
+
+
+def table(parameter_sets, logged, water, seconds, sessions=False):
+    """Print a comparison of each parameter set against the logged sessions"""
+    print(f"{'parameters':40} {'water mm':>10} {'valve s':>10} "
+          f"{'d water':>10} {'d valve s':>10} {'max |d|':>8}")
+    print(f"{'(logged)':40} {logged['water'].sum():10.2f} {logged['seconds'].sum():10.1f}")
+
+    for p, w, s in zip(parameter_sets, water, seconds):
+        name = " ".join(f"{k}={v}" for k, v in p.items()) or "(current)"
+        delta = w - logged['water']
+        print(f"{name:40} {w.sum():10.2f} {s.sum():10.1f} "
+              f"{delta.sum():+10.2f} {(s - logged['seconds']).sum():+10.1f} "
+              f"{np.abs(delta).max(initial=0):8.2f}")
+        if sessions:
+            print("    per-session water delta: " +
+                  " ".join(f"{d:+.2f}" for d in delta))
+
+
+def parse_assignment(text):
+    name, _, values = text.partition('=')
+    if name not in soil.PARAMETERS:
+        raise argparse.ArgumentTypeError(f"unknown parameter {name}")
+    return name, [float(v) for v in values.split(',')]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--log', default="log.db", help="log database file")
+    parser.add_argument('--set', type=parse_assignment, action='append', default=[],
+                        metavar="NAME=VALUE", help="fix a parameter")
+    parser.add_argument('--sweep', type=parse_assignment, action='append', default=[],
+                        metavar="NAME=V1,V2,...", help="replay each value of a parameter")
+    parser.add_argument('--sessions', action='store_true', help="print per-session deltas")
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    soil.DEBUG = False
+
+    # Same irrigation system as app.py
+    irrigation = IrrigationModel(us_gallons=40.3, seconds=60*60, area_square_feet=70)
+
+    conditions, logged = load(Log(args.log).range())
+    sets = parameter_sets({name: values[0] for name, values in args.set},
+                          dict(args.sweep))
+    water, seconds = replay_parallel(conditions, irrigation, sets, workers=args.workers)
+
+    print(f"Replayed {len(logged['water'])} sessions with {len(sets)} parameter sets")
+    table(sets, logged, water, seconds, sessions=args.sessions)
@@ -0,0 +1,228 @@
+"""Continuous background sampling of the soil moisture sensor
+
+A thread reads the sensor at a fixed interval. Raw readings are kept in a
+fixed-size ring buffer, and minute and hour rollups (min/mean/max/median) are
+added as each period ends. All storage is allocated up front, so memory use
+stays constant no matter how long the sampler runs.
+
+measure() returns the median of recent samples, which filters out the
+occasional noisy reading, in the same form as SoilMoistureSensor.measure().
+
+Every sample can also be kept on disk in a TelemetryStore (see telemetry.py).
+"""
+
+import threading
+import time
+import traceback
+
+import numpy as np
+
+
+class RingBuffer:
+    """Fixed-size buffer of rows of floats, overwriting the oldest row
+
+    capacity:  Number of rows kept
+    fields:    Names of the columns in each row
+    """
+
+    def __init__(self, capacity, fields):
+        self.fields = fields
+        self.data = np.zeros((capacity, len(fields)))
+        self.index = 0
+        self.count = 0
+
+
+    def append(self, *row):
+        self.data[self.index] = row
+        self.index = (self.index + 1) % len(self.data)
+        self.count = min(self.count + 1, len(self.data))
+
+
+    def last(self, n=None):
+        """Return the newest n rows (default all) as an array, oldest first"""
+        n = self.count if n is None else min(n, self.count)
+        rows = np.arange(self.index - n, self.index) % len(self.data)
+        return self.data[rows]
+
+
+class Rollup:
+    """Summary statistics of samples over consecutive periods of time
+
+    period:    Length of each period in seconds
+    samples:   Largest number of samples expected in one period
+    history:   Number of periods to keep
+    """
+
+    FIELDS = ("start", "min", "mean", "max", "median")
+
+    def __init__(self, period, samples, history):
+        self.period = period
+        self.bucket = np.zeros(samples)
+        self.count = 0
+        self.start = None
+        self.history = RingBuffer(history, self.FIELDS)
+
+
+    def add(self, t, value):
+        start = t - t % self.period
+        if start != self.start:
+            self.close()
+            self.start = start
+        if self.count < len(self.bucket):
+            self.bucket[self.count] = value
+            self.count += 1
+
+
+    def summary(self):
+        b = self.bucket[:self.count]
+        return (self.start, b.min(), b.mean(), b.max(), np.median(b))
+
+
+    def close(self):
+        """Summarize the current period into the history"""
+        if self.count:
+            self.history.append(*self.summary())
+        self.count = 0
+
+
+    def rows(self):
+        """Return the history, and the period in progress, as dictionaries"""
+        rows = list(self.history.last())
+        if self.count:
+            rows.append(self.summary())
+        return [dict(zip(self.FIELDS, map(float, r))) for r in rows]
+
+
+class Sampler:
+    """Samples a SoilMoistureSensor in a background thread
+
+    sensor:     SoilMoistureSensor (or anything with the same measure())
+    interval:   Seconds between samples
+    capacity:   Number of raw samples kept
+    filter:     Number of recent samples whose median measure() returns
+    store:      Optional TelemetryStore to which every sample is appended
+    name:       Sensor name in the store
+    debug:      Print errors from the sensor
+    """
+
+    def __init__(self, sensor, interval=1.0, capacity=3600, filter=15,
+                 store=None, name="soil", debug=False):
+        self.sensor = sensor
+        self.interval = interval
+        self.filter = filter
+        self.store = store
+        self.name = name
+        self.debug = debug
+        self.errors = 0
+
+        self.lock = threading.Lock()
+        # the sensor isn't thread safe, and measure() may read it directly
+        self.sensor_lock = threading.Lock()
+        self.raw = RingBuffer(capacity, ("time", "value"))
+        per_minute = int(np.ceil(60 / interval)) + 1
+        self.minutes = Rollup(60, per_minute, 24*60)            # one day
+        self.hours = Rollup(60*60, per_minute*60, 90*24)        # 90 days
+
+        self.stopped = threading.Event()
+        self.thread = None
+        self.last = None  # (time, monotonic time) of the last sample
+
+
+    def start(self):
+        """Start sampling in a daemon thread. Returns self."""
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread: self.thread.join()
+
+
+    def run(self):
+        # Sample on a fixed grid of times, so slow reads don't cause drift
+        due = time.monotonic()
+        while not self.stopped.is_set():
+            self.sample()
+            due += self.interval
+            self.stopped.wait(max(0, due - time.monotonic()))
+
+
+    def sample(self):
+        """Take one reading and add it to the buffer and rollups"""
+        try:
+            value = self.read()["sensor_value"]
+        except Exception:
+            self.errors += 1
+            if self.debug: traceback.print_exc()
+            return
+
+        t = self.timestamp()
+        with self.lock:
+            self.raw.append(t, value)
+            self.minutes.add(t, value)
+            self.hours.add(t, value)
+
+        if self.store is not None:
+            try:
+                self.store.append(self.name, value, t)
+            except Exception:
+                self.errors += 1
+                if self.debug: traceback.print_exc()
+
+
+    def timestamp(self):
+        """Return the time of a sample, which never goes backwards
+
+        If the clock is stepped back (e.g. by NTP), samples carry on from the
+        last timestamp at the pace of the monotonic clock until the clock
+        catches up, since the telemetry store only accepts increasing times.
+        """
+        t, tick = time.time(), time.monotonic()
+        if self.last is not None and t < self.last[0]:
+            t = self.last[0] + (tick - self.last[1])
+        self.last = (t, tick)
+        return t
+
+
+    def measure(self):
+        """Return the median of the recent samples like SoilMoistureSensor.measure()
+
+        Falls back to a direct sensor reading if there are no recent samples
+        (e.g. sampling just started, or the sensor has been failing).
+        """
+        with self.lock:
+            recent = self.raw.last(self.filter)
+        recent = recent[recent[:, 0] >= time.time() - 2 * self.filter * self.interval]
+        if len(recent) == 0:
+            return self.read()
+        return {"sensor_value": round(float(np.median(recent[:, 1])), 2)}
+
+
+    def read(self):
+        """Read the sensor directly, never at the same time as another thread"""
+        with self.sensor_lock:
+            return self.sensor.measure()
+
+
+    def rollups(self):
+        """Return the minute and hour rollups as lists of dictionaries"""
+        with self.lock:
+            return {"minute": self.minutes.rows(), "hour": self.hours.rows()}
+
+
+if __name__ == "__main__":
+    import random
+    from pprint import pprint
+
+    class NoisySensor:
+        def measure(self):
+            value = 40 + random.gauss(0, 1) + (30 if random.random() < 0.05 else 0)
+            return {"sensor_value": value}
+
+    sampler = Sampler(NoisySensor(), interval=0.01, filter=51).start()
+    time.sleep(2)
+    sampler.stop()
+    print(sampler.measure())
+    pprint(sampler.rollups()["minute"])
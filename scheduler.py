@@ -0,0 +1,111 @@
+"""Daily calendar scheduler for running the watering session in a daemon
+
+This is the in-process equivalent of the systemd timer in
+systemd/ogarden.timer:
+
+    OnCalendar=06,18:00
+    Persistent=true
+
+The job runs at each time of day in the schedule. With persistent, a scheduled
+time which was missed while the daemon was not running (for instance during a
+power outage) is caught up once, immediately at start-up. The time of the last
+attempt is saved to a state file (like the timer's stamp file), so a session
+which failed is not attempted again at every start-up.
+"""
+
+import os
+import traceback
+from datetime import datetime, time, timedelta
+from time import sleep
+
+
+class Schedule:
+    """Times of day at which to run
+
+    times:  Iterable of "HH:MM" strings, or a comma separated string
+    """
+
+    def __init__(self, times=("06:00", "18:00")):
+        if isinstance(times, str):
+            times = times.split(',')
+        self.times = sorted(time.fromisoformat(t.strip()) for t in times)
+
+
+    def next(self, after):
+        """Return the first scheduled datetime strictly after after"""
+        for days in range(2):
+            day = after.date() + timedelta(days=days)
+            for t in self.times:
+                d = datetime.combine(day, t)
+                if d > after:
+                    return d
+
+
+    def previous(self, before):
+        """Return the last scheduled datetime at or before before"""
+        for days in range(2):
+            day = before.date() - timedelta(days=days)
+            for t in reversed(self.times):
+                d = datetime.combine(day, t)
+                if d <= before:
+                    return d
+
+
+def run(schedule, job, last_run=None, persistent=True, poll=60, state_file=None):
+    """Run job at every scheduled time. Never returns.
+
+    last_run:    datetime of the last time the job ran, if known
+    persistent:  If a scheduled time was missed since last_run, run job
+                 immediately
+    poll:        Longest time in seconds to sleep before checking the clock
+                 again, so clock changes (e.g. NTP sync at boot) are noticed
+    state_file:  Where the time of each attempt is saved. The saved time
+                 takes precedence over last_run.
+    """
+    last_run = load_last_run(state_file) or last_run
+    if persistent and last_run is not None and \
+       schedule.previous(datetime.now()) > last_run:
+        print(f"{datetime.now()} | Catching up on a missed session")
+        run_job(job, state_file)
+
+    while True:
+        due = schedule.next(datetime.now())
+        print(f"{datetime.now()} | Next session at {due}")
+        while datetime.now() < due:
+            sleep(min(poll, max(0, (due - datetime.now()).total_seconds())))
+        run_job(job, state_file)
+
+
+def load_last_run(state_file):
+    """Return the time of the last attempt saved in state_file, or None"""
+    try:
+        with open(state_file) as f:
+            return datetime.fromisoformat(f.read().strip())
+    except (TypeError, OSError, ValueError):
+        return None
+
+
+def save_last_run(state_file, t):
+    with open(state_file + ".tmp", 'w') as f:
+        f.write(t.isoformat())
+    os.replace(state_file + ".tmp", state_file)
+
+
+def run_job(job, state_file=None):
+    """Run job, printing rather than raising any error so the daemon lives on
+
+    The attempt is saved to state_file first, so it counts even if job fails
+    or the process dies.
+    """
+    if state_file is not None:
+        save_last_run(state_file, datetime.now())
+    try:
+        job()
+    except Exception:
+        traceback.print_exc()
+
+
+if __name__ == "__main__":
+    schedule = Schedule()
+    now = datetime.now()
+    print(f"now {now}, previous {schedule.previous(now)}, next {schedule.next(now)}")
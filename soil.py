@@ -7,12 +7,23 @@ Determines how much soil should we watered right now, given:
 
 Returns
     - depth of water to apply uniformly to soil
+
+calculate() evaluates one set of conditions. calculate_batch() evaluates arrays
+of conditions and model parameters at once, for what-if analysis.
+
+The parameters below are starting guesses. calibrate.py fits them to the
+logged sessions and writes them to a parameter file, which load_parameters()
+reads.
 """
 
 DEBUG = True
 
+import json
+import os
 from datetime import datetime
 
+import numpy as np
+
 SEASON_START_MONTH_DAY = (5, 11) # month and day of start of growing season (last frost)
 
 # Model parameters
@@ -37,6 +48,67 @@ SENSOR_K = 1.0            # scaling factor
 SEASON_K = 0.0016         # scaling factor
 
 
+PARAMETERS = ["BASE_WATER_AMOUNT", "PRECIPITATION_K",
+              "HUMIDITY_NOMINAL", "HUMIDITY_K",
+              "SKYCOVER_NOMINAL", "SKYCOVER_K",
+              "TEMPERATURE_NOMINAL", "TEMPERATURE_K",
+              "WIND_NOMINAL", "WIND_K",
+              "SENSOR_NOMINAL", "SENSOR_K",
+              "SEASON_K"]
+
+# Format version of parameter files written by calibrate.py
+PARAMETER_FILE_VERSION = 1
+
+# Fields of the breakdown returned by calculate_batch, in the order the
+# corrections are applied
+BREAKDOWN = ["base", "sensor", "precipitation", "humidity", "sky_cover",
+             "temperature", "wind", "season", "water"]
+
+
+def parameters():
+    """Return the current model parameters as a dictionary"""
+    return {name: globals()[name] for name in PARAMETERS}
+
+
+def load_parameters(file="soil_params.json", missing_ok=False):
+    """Replace the model parameters with those in a parameter file
+
+    Returns the parameters loaded, or None if the file doesn't exist and
+    missing_ok is True.
+    """
+    if missing_ok and not os.path.exists(file):
+        return None
+
+    with open(file) as f:
+        data = json.load(f)
+    if data.get('version') != PARAMETER_FILE_VERSION:
+        raise ValueError(f"{file} has parameter file version {data.get('version')}, "
+                         f"expected {PARAMETER_FILE_VERSION}")
+
+    loaded = {name: float(value) for name, value in data['parameters'].items()
+              if name in PARAMETERS}
+    globals().update(loaded)
+    if DEBUG: print(f"loaded {len(loaded)} parameters from {file} "
+                    f"(revision {data.get('revision')})")
+    return loaded
+
+
+def season_days(now, season_start=None):
+    """Return whole days since the start of the growing season
+
+    now and season_start may be datetimes, numpy.datetime64 or arrays of
+    them. season_start defaults to SEASON_START_MONTH_DAY in the year of now.
+    """
+    now = np.asarray(now, dtype='datetime64[us]')
+    if season_start is None:
+        month, day = SEASON_START_MONTH_DAY
+        year = now.astype('datetime64[Y]')
+        season_start = year.astype('datetime64[M]') + (month - 1)
+        season_start = season_start.astype('datetime64[D]') + (day - 1)
+    season_start = np.asarray(season_start, dtype='datetime64[us]')
+    return (now - season_start) // np.timedelta64(1, 'D')
+
+
 def calculate(ave_probability_of_precipitation = 0,
               ave_relative_humidity = HUMIDITY_NOMINAL,
               ave_sky_cover = SKYCOVER_NOMINAL,
@@ -47,45 +119,110 @@ def calculate(ave_probability_of_precipitation = 0,
               sensor_value = SENSOR_NOMINAL,
               sensor_min = 0,
               sensor_max = 100,
-              season_start = datetime(datetime.now().year, *SEASON_START_MONTH_DAY)):
-
-    water = BASE_WATER_AMOUNT 
-    if DEBUG: print(f"{water} from base amount")
-
-    # reduce watering if soil moisture sensor indicates soil is already above nominal wetness 
-    water -= (sensor_value - SENSOR_NOMINAL)/SENSOR_NOMINAL * SENSOR_K * BASE_WATER_AMOUNT
-    if DEBUG: print(f"{water} after correcting for soil moisture sensor")
-
-    # reduce watering when precipitation is in the forecast
-    water -= total_precipitation * PRECIPITATION_K
-    if DEBUG: print(f"{water} after correcting for precip")
-
-    # reduce watering in high humidity
-    water -= (ave_relative_humidity - HUMIDITY_NOMINAL)/HUMIDITY_NOMINAL * HUMIDITY_K * BASE_WATER_AMOUNT
-    if DEBUG: print(f"{water} after correcting for humidity")
-
-    # reduce watering for cloudy days
-    water -= (ave_sky_cover - SKYCOVER_NOMINAL)/SKYCOVER_NOMINAL * SKYCOVER_K * BASE_WATER_AMOUNT
-    if DEBUG: print(f"{water} after correcting for skycover")
-
-    # increase watering on hot days
-    water += (ave_temperature - TEMPERATURE_NOMINAL)/TEMPERATURE_NOMINAL * TEMPERATURE_K * BASE_WATER_AMOUNT
-    if DEBUG: print(f"{water} after correcting for temperature")
-
-    # increase watering on windy days
-    wind = (ave_wind_speed + ave_wind_gust) / 2
-    water += (wind - WIND_NOMINAL)/WIND_NOMINAL * WIND_K * BASE_WATER_AMOUNT
-    if DEBUG: print(f"{water} after correcting for wind")
-
-    # increase watering as the season progresses (and plants grow)
-    water += (datetime.now() - season_start).days * SEASON_K * BASE_WATER_AMOUNT
-    if DEBUG: print(f"{water} after correcting for season")
+              season_start = None,
+              now = None):
+    """Return the depth of water (mm) to apply for one set of conditions
+
+    season_start defaults to SEASON_START_MONTH_DAY in the year of now, and
+    now defaults to the current time.
+    """
+    water, breakdown = calculate_batch(
+        ave_probability_of_precipitation=ave_probability_of_precipitation,
+        ave_relative_humidity=ave_relative_humidity,
+        ave_sky_cover=ave_sky_cover,
+        ave_temperature=ave_temperature,
+        ave_wind_gust=ave_wind_gust,
+        ave_wind_speed=ave_wind_speed,
+        total_precipitation=total_precipitation,
+        sensor_value=sensor_value,
+        season_start=season_start,
+        now=now,
+        breakdown=True)
+
+    if DEBUG:
+        print(f"{breakdown['base']} from base amount")
+        total = breakdown['base']
+        for name in BREAKDOWN[1:-1]:
+            total = total + breakdown[name]
+            print(f"{total} after correcting for {name}")
+
+    return float(water)
+
+
+def calculate_batch(ave_probability_of_precipitation = 0,
+                    ave_relative_humidity = HUMIDITY_NOMINAL,
+                    ave_sky_cover = SKYCOVER_NOMINAL,
+                    ave_temperature = TEMPERATURE_NOMINAL,
+                    ave_wind_gust = WIND_NOMINAL,
+                    ave_wind_speed = WIND_NOMINAL,
+                    total_precipitation = 0,
+                    sensor_value = SENSOR_NOMINAL,
+                    season_start = None,
+                    now = None,
+                    params = None,
+                    breakdown = False):
+    """Vectorized calculate() over arrays of conditions and parameters
+
+    Every condition, now and season_start (datetimes or numpy.datetime64), and
+    every value in params (a dictionary of PARAMETERS overriding the module
+    values) may be a scalar or an array. All of them are broadcast together.
+
+    Returns an array of water amounts. If breakdown is True, returns a tuple
+    of the water amounts and a structured array with the signed contribution
+    of each correction in BREAKDOWN, and the final water amount.
+
+    The arithmetic is the same, in the same order, as in calculate(), so
+    results are identical to the scalar path.
+    """
+    p = {name: np.asarray(value, dtype=float)
+         for name, value in {**parameters(), **(params or {})}.items()}
+    B = p['BASE_WATER_AMOUNT']
+
+    days = season_days(now if now is not None else datetime.now(), season_start)
+
+    wind = (np.asarray(ave_wind_speed) + ave_wind_gust) / 2
+
+    corrections = [
+        # reduce watering if soil moisture sensor indicates soil is already above nominal wetness
+        -((np.asarray(sensor_value) - p['SENSOR_NOMINAL'])/p['SENSOR_NOMINAL'] * p['SENSOR_K'] * B),
+        # reduce watering when precipitation is in the forecast
+        -(np.asarray(total_precipitation) * p['PRECIPITATION_K']),
+        # reduce watering in high humidity
+        -((np.asarray(ave_relative_humidity) - p['HUMIDITY_NOMINAL'])/p['HUMIDITY_NOMINAL'] * p['HUMIDITY_K'] * B),
+        # reduce watering for cloudy days
+        -((np.asarray(ave_sky_cover) - p['SKYCOVER_NOMINAL'])/p['SKYCOVER_NOMINAL'] * p['SKYCOVER_K'] * B),
+        # increase watering on hot days
+        (np.asarray(ave_temperature) - p['TEMPERATURE_NOMINAL'])/p['TEMPERATURE_NOMINAL'] * p['TEMPERATURE_K'] * B,
+        # increase watering on windy days
+        (wind - p['WIND_NOMINAL'])/p['WIND_NOMINAL'] * p['WIND_K'] * B,
+        # increase watering as the season progresses (and plants grow)
+        days * p['SEASON_K'] * B,
+    ]
+
+    shape = np.broadcast_shapes(B.shape, *(np.shape(c) for c in corrections))
+    water = np.broadcast_to(B, shape)
+    for c in corrections:
+        water = water + c
 
     # Clamp lower limit at zero just in case a correction made it go negative
-    water = 0 if water<0 else water
-
-    return round(water, 2)
-
+    water = np.where(water < 0, 0., water)
+
+    # Round like Python's round(), as in calculate(). np.round() only differs
+    # from it on values about halfway between hundredths (e.g. 3.255), so
+    # those few are rounded by round() itself.
+    hundredths = water * 100
+    halfway = np.abs(hundredths - np.floor(hundredths) - 0.5) < 1e-6
+    rounded = np.array(np.round(water, 2))
+    rounded[halfway] = [round(w, 2) for w in water[halfway].tolist()]
+    water = rounded
+
+    if not breakdown:
+        return water
+
+    result = np.empty(shape, dtype=[(name, float) for name in BREAKDOWN])
+    for name, value in zip(BREAKDOWN, [B, *corrections, water]):
+        result[name] = value
+    return water, result
 
 
 if __name__ == "__main__":
@@ -18,10 +18,14 @@ Installing SMBus2 Python Library:
 """
 
 import smbus2
+import threading
+import time
 import warnings
 from time import sleep
 from pprint import pprint
 
+import metrics
+
 
 class SoilMoistureSensor:
     """Soil moisture sensor class
@@ -33,10 +37,12 @@ class SoilMoistureSensor:
     wet:     Set point for wet soil (take measurement in water)
     debug:   None or value. If value, SMBus errors are supressed and a mock
              response of value is returned.
+    bus:     Optional shared I2CBus (see i2c_bus.py). Sensors on a shared bus
+             use its single handle and lock instead of opening their own.
     """
 
 
-    def __init__(self, address=0x10, port=1, dry=11000, wet=22000, debug=None):
+    def __init__(self, address=0x10, port=1, dry=11000, wet=22000, debug=None, bus=None):
         """Create soil moisture sensor object
         """
         self.address = address
@@ -49,8 +55,11 @@ class SoilMoistureSensor:
         self.raw = 0
         self.percent = 0
 
-        self.bus = smbus2.SMBus(self.port)
-        sleep(0.1) # this resolves a race condition when immediately measuring
+        if bus is not None:
+            self.bus = bus
+        else:
+            self.bus = smbus2.SMBus(self.port)
+            sleep(0.1) # this resolves a race condition when immediately measuring
 
 
     def measure(self):
@@ -58,7 +67,8 @@ class SoilMoistureSensor:
 
         try:
             # Read 2 bytes, starting at offset 0, from address
-            self.response = self.bus.read_i2c_block_data(self.address, 0, 4)
+            with metrics.timer("i2c_read"):
+                self.response = self.bus.read_i2c_block_data(self.address, 0, 4)
         except:
             if self.debug:
                 # If debug exists, we will pretend this came from the sensor
@@ -110,6 +120,53 @@ class SoilMoistureSensor:
                f"Wet {self.wet}" 
 
 
+class CachedSensor:
+    """Shares recent readings of a sensor between many callers
+
+    Readings up to max_age seconds old are returned from the cache. Only one
+    caller reads the sensor at a time; callers which arrive while a read is in
+    flight wait for it and share its result instead of reading again.
+
+    Keyword arguments:
+    sensor:   SoilMoistureSensor (or anything with the same measure())
+    max_age:  Seconds a reading may be reused
+    """
+
+    def __init__(self, sensor, max_age=5.0):
+        self.sensor = sensor
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.reading = None
+        self.time = None
+
+
+    def measure(self, fresh=False):
+        """Return a reading like SoilMoistureSensor.measure(), plus its "age"
+        in seconds.
+
+        fresh:  If True, return a reading taken after this call was made
+        """
+        requested = time.monotonic()
+        if not fresh and self.time is not None and \
+           requested - self.time <= self.max_age:
+            return self.result()
+
+        with self.lock:
+            # A read which started after this call, while we waited for the
+            # lock, is good enough. Readings are timed from the start of the
+            # read, so one already in flight when fresh was asked for isn't.
+            if self.time is None or self.time < requested:
+                started = time.monotonic()
+                reading = self.sensor.measure()
+                self.reading, self.time = reading, started
+            return self.result()
+
+
+    def result(self):
+        reading, t = self.reading, self.time
+        return {**reading, "age": round(time.monotonic() - t, 3)}
+
+
 if __name__ == "__main__":
     from time import sleep
 
@@ -0,0 +1,63 @@
+"""Start-up profiling
+
+Records how long each import and object creation takes while the application
+starts, including steps that run in background threads. Recording a step
+only reads the clock, so the profile is always kept; "python app.py
+--profile-startup" prints it.
+
+Usage:
+    profile = Profile()
+    with profile.step("import weather"):
+        import weather
+    profile.report()
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+import metrics
+
+
+class Profile:
+    """Timeline of start-up steps, measured from when it was created"""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.steps = []  # (name, thread name, start offset, duration)
+        self.lock = threading.Lock()
+
+
+    @contextmanager
+    def step(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            metrics.set_gauge("startup_step_seconds", duration, step=name)
+            with self.lock:
+                self.steps.append((name, threading.current_thread().name,
+                                   start - self.start, duration))
+
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+
+    def report(self):
+        """Print the steps in the order they started, and the total time"""
+        print(f"{'step':40} {'thread':24} {'start':>8} {'seconds':>8}")
+        with self.lock:
+            for name, thread, start, duration in sorted(self.steps, key=lambda s: s[2]):
+                print(f"{name:40} {thread:24} {start:8.3f} {duration:8.3f}")
+        print(f"{'total':40} {'':24} {'':8} {self.elapsed():8.3f}")
+
+
+if __name__ == "__main__":
+    profile = Profile()
+    with profile.step("import numpy"):
+        import numpy as np
+    with profile.step("sum"):
+        np.arange(10**7).sum()
+    profile.report()
@@ -0,0 +1,325 @@
+"""Append-only store for high-frequency sensor telemetry
+
+The log holds a couple of records a day. Sampling probes every second would
+add tens of thousands of readings a day each, so readings go to this store
+instead: one file per sensor, made of fixed-size chunks.
+
+File layout (little-endian):
+
+    file header  32 bytes: magic, format version, samples per chunk, and the
+                 low and high ends of the quantization range
+    chunk        8 byte base time (ms since the epoch), then up to
+                 chunk_samples records of 6 bytes each:
+                     uint32  ms since the chunk's base time (delta-encoded)
+                     uint16  value quantized to 65535 steps between low and
+                             high (65535 means no value)
+
+So a sample takes 6 bytes on flash, and chunk i always starts at a known
+offset. Reads memory-map the file and only decode the chunks which overlap
+the requested range.
+
+Appends only ever add bytes to the end of the file. A crash can at most leave
+a partial record at the end, which is truncated when the file is next opened.
+Timestamps must not go backwards.
+
+Usage:
+    store = TelemetryStore("telemetry")
+    store.append("soil", 41.25)
+    times, values = store.range("soil", since=time.time() - 3600)
+    store.downsample("soil", interval=60)
+"""
+
+import os
+import struct
+import threading
+import time
+
+import numpy as np
+
+MAGIC = b"OGTS"
+FORMAT_VERSION = 1
+FILE_HEADER = struct.Struct("<4sHIdd")
+FILE_HEADER_SIZE = 32
+CHUNK_HEADER = struct.Struct("<q")
+RECORD = np.dtype([("offset", "<u4"), ("value", "<u2")])
+MISSING = 65535
+MAX_OFFSET = 2**32 - 1  # ms, about 49 days
+
+
+class Series:
+    """One sensor's telemetry file
+
+    path:           File path
+    chunk_samples:  Samples per chunk, for a new file
+    low, high:      Quantization range, for a new file
+    sync:           fsync after every append, at the cost of flash wear
+    readonly:       Only read, e.g. while another process appends
+    """
+
+    def __init__(self, path, chunk_samples=4096, low=0.0, high=100.0, sync=False,
+                 readonly=False):
+        self.path = path
+        self.sync = sync
+
+        if not readonly and \
+           (not os.path.exists(path) or os.path.getsize(path) < FILE_HEADER_SIZE):
+            with open(path, 'wb') as f:
+                f.write(FILE_HEADER.pack(MAGIC, FORMAT_VERSION, chunk_samples, low, high)
+                        .ljust(FILE_HEADER_SIZE, b"\0"))
+                f.flush()
+                os.fsync(f.fileno())
+
+        with open(path, 'rb') as f:
+            magic, version, self.chunk_samples, self.low, self.high = \
+                FILE_HEADER.unpack(f.read(FILE_HEADER.size))
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError(f"{path} is not a version {FORMAT_VERSION} telemetry file")
+        self.chunk_size = CHUNK_HEADER.size + self.chunk_samples * RECORD.itemsize
+        self.scale = (self.high - self.low) / (MISSING - 1)
+
+        self.fd = None
+        if readonly:
+            return
+
+        self.repair()
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND)
+
+        # state of the last chunk, for appending
+        self.count = self.samples()
+        bases = self.bases()
+        self.base = int(bases[-1]) if len(bases) else None
+        last = self.read_chunk(len(bases) - 1) if len(bases) else None
+        self.last = self.base + int(last["offset"][-1]) if last is not None and len(last) else self.base
+
+
+    def repair(self):
+        """Truncate a partial record, or a chunk header without records, left
+        by a crash (appends always write a new chunk's header together with
+        its first record)"""
+        size = os.path.getsize(self.path) - FILE_HEADER_SIZE
+        chunks, rest = divmod(size, self.chunk_size)
+        if rest < CHUNK_HEADER.size + RECORD.itemsize:
+            valid = chunks * self.chunk_size
+        else:
+            valid = chunks * self.chunk_size + CHUNK_HEADER.size + \
+                    (rest - CHUNK_HEADER.size) // RECORD.itemsize * RECORD.itemsize
+        if valid != size:
+            os.truncate(self.path, FILE_HEADER_SIZE + valid)
+
+
+    def samples(self):
+        """Number of samples in the file"""
+        size = os.path.getsize(self.path) - FILE_HEADER_SIZE
+        chunks, rest = divmod(size, self.chunk_size)
+        return chunks * self.chunk_samples + max(0, rest - CHUNK_HEADER.size) // RECORD.itemsize
+
+
+    def quantize(self, values):
+        values = np.asarray(values, dtype=float)
+        q = np.rint((np.clip(values, self.low, self.high) - self.low) / self.scale)
+        return np.where(np.isnan(values), MISSING, q).astype("<u2")
+
+
+    def append(self, times_ms, values):
+        """Append samples: integer ms since the epoch and values"""
+        times_ms = np.asarray(times_ms, dtype=np.int64)
+        quantized = self.quantize(values)
+        if len(times_ms) == 0:
+            return
+        if (self.last is not None and times_ms[0] < self.last) or np.any(np.diff(times_ms) < 0):
+            raise ValueError("Telemetry timestamps must not go backwards")
+
+        # build the bytes of all new records and chunk headers, then write
+        # them with one call
+        data = bytearray()
+        for t, q in zip(times_ms.tolist(), quantized.tolist()):
+            if self.base is None or self.count % self.chunk_samples == 0 or \
+               t - self.base > MAX_OFFSET:
+                if self.base is not None and self.count % self.chunk_samples:
+                    # the current chunk can't hold this offset: pad it with
+                    # missing values so the next chunk starts where expected
+                    pad = self.chunk_samples - self.count % self.chunk_samples
+                    record = np.array([(self.last - self.base, MISSING)], dtype=RECORD)
+                    data += record.tobytes() * pad
+                    self.count += pad
+                self.base = t
+                data += CHUNK_HEADER.pack(t)
+            data += np.array([(t - self.base, q)], dtype=RECORD).tobytes()
+            self.count += 1
+            self.last = t
+
+        os.write(self.fd, bytes(data))
+        if self.sync:
+            os.fsync(self.fd)
+
+
+    def map(self):
+        """Memory-map the file, or return None if it has no samples"""
+        if os.path.getsize(self.path) <= FILE_HEADER_SIZE:
+            return None
+        return np.memmap(self.path, dtype=np.uint8, mode='r')
+
+
+    def bases(self, mm=None):
+        """Base times (ms) of all chunks, read straight from the map"""
+        mm = self.map() if mm is None else mm
+        if mm is None:
+            return np.empty(0, dtype=np.int64)
+        # chunks whose header is complete (another process may be appending)
+        chunks = (len(mm) - FILE_HEADER_SIZE + self.chunk_size - CHUNK_HEADER.size) // self.chunk_size
+        return np.ndarray((chunks,), dtype="<i8", buffer=mm, offset=FILE_HEADER_SIZE,
+                          strides=(self.chunk_size,)).copy()
+
+
+    def read_chunk(self, i, mm=None):
+        """Records of chunk i, as a view of the memory map"""
+        mm = self.map() if mm is None else mm
+        start = FILE_HEADER_SIZE + i * self.chunk_size + CHUNK_HEADER.size
+        count = min(self.chunk_samples, (len(mm) - start) // RECORD.itemsize)
+        return np.ndarray((count,), dtype=RECORD, buffer=mm, offset=start)
+
+
+    def range(self, since_ms=None, until_ms=None):
+        """Return times (ms) and values of samples in [since_ms, until_ms)
+
+        Chunks are found from their base times; only chunks which may hold
+        samples in the range are decoded.
+        """
+        mm = self.map()
+        if mm is None:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        bases = self.bases(mm)
+
+        # a chunk holds samples from its base time until the next chunk's
+        first = 0 if since_ms is None else max(0, np.searchsorted(bases, since_ms, 'right') - 1)
+        last = len(bases) if until_ms is None else np.searchsorted(bases, until_ms, 'left')
+
+        times, values = [], []
+        for i in range(first, last):
+            records = self.read_chunk(i, mm)
+            keep = records["value"] != MISSING
+            t = bases[i] + records["offset"][keep].astype(np.int64)
+            v = records["value"][keep]
+            mask = np.ones(len(t), dtype=bool)
+            if since_ms is not None:
+                mask &= t >= since_ms
+            if until_ms is not None:
+                mask &= t < until_ms
+            times.append(t[mask])
+            values.append(self.low + v[mask] * self.scale)
+
+        if not times:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        return np.concatenate(times), np.concatenate(values)
+
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+
+
+class TelemetryStore:
+    """Directory of telemetry files, one Series per sensor
+
+    directory:      Where the files are stored
+    chunk_samples:  Samples per chunk of new files
+    low, high:      Quantization range of new files (sensor_value is 0-100%,
+                    which gives a resolution of about 0.0015%)
+    sync:           fsync after every append
+    readonly:       Only read the files, which another process appends to
+    """
+
+    def __init__(self, directory="telemetry", chunk_samples=4096, low=0.0, high=100.0,
+                 sync=False, readonly=False):
+        self.directory = directory
+        self.options = dict(chunk_samples=chunk_samples, low=low, high=high, sync=sync,
+                            readonly=readonly)
+        self.series = {}
+        self.lock = threading.Lock()
+        if not readonly:
+            os.makedirs(directory, exist_ok=True)
+
+
+    def get(self, sensor):
+        with self.lock:
+            if sensor not in self.series:
+                self.series[sensor] = Series(os.path.join(self.directory, sensor + ".tlm"),
+                                             **self.options)
+            return self.series[sensor]
+
+
+    def append(self, sensor, value, t=None):
+        """Append one reading. t is seconds since the epoch, default now."""
+        self.extend(sensor, [time.time() if t is None else t], [value])
+
+
+    def extend(self, sensor, times, values):
+        """Append readings. times are seconds since the epoch."""
+        series = self.get(sensor)
+        with self.lock:
+            series.append(np.rint(np.asarray(times, dtype=float) * 1000), values)
+
+
+    def range(self, sensor, since=None, until=None):
+        """Return arrays of times (seconds since the epoch) and values"""
+        times, values = self.get(sensor).range(to_ms(since), to_ms(until))
+        return times / 1000, values
+
+
+    def downsample(self, sensor, since=None, until=None, interval=60):
+        """Return per-interval statistics of readings as columns
+
+        Returns a dictionary of lists: "time" (start of each interval with
+        readings, in seconds since the epoch), "count", "mean", "min" and
+        "max".
+        """
+        times, values = self.range(sensor, since, until)
+        if len(times) == 0:
+            return {"time": [], "count": [], "mean": [], "min": [], "max": []}
+
+        bucket = np.floor(times / interval).astype(np.int64)
+        starts = np.flatnonzero(np.r_[True, bucket[1:] != bucket[:-1]])
+        count = np.diff(np.r_[starts, len(values)])
+        return {"time": (bucket[starts] * interval).tolist(),
+                "count": count.tolist(),
+                "mean": np.round(np.add.reduceat(values, starts) / count, 3).tolist(),
+                "min": np.round(np.minimum.reduceat(values, starts), 3).tolist(),
+                "max": np.round(np.maximum.reduceat(values, starts), 3).tolist()}
+
+
+    def sensors(self):
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(name[:-4] for name in os.listdir(self.directory) if name.endswith(".tlm"))
+
+
+    def close(self):
+        with self.lock:
+            for series in self.series.values():
+                series.close()
+            self.series = {}
+
+
+def to_ms(t):
+    return None if t is None else int(round(t * 1000))
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    store = TelemetryStore(tempfile.mkdtemp(), chunk_samples=1024)
+    now = time.time()
+    day = now - 24*60*60 + np.arange(24*60*60)
+    values = 40 + 5 * np.sin(day / 3600) + np.random.normal(0, 0.2, len(day))
+
+    start = time.perf_counter()
+    store.extend("soil", day, values)
+    print(f"appended {len(day)} samples in {time.perf_counter() - start:.2f}s")
+    size = os.path.getsize(os.path.join(store.directory, "soil.tlm"))
+    print(f"{size} bytes, {size / len(day):.2f} bytes per sample")
+
+    start = time.perf_counter()
+    times, read = store.range("soil", since=now - 3600)
+    print(f"last hour: {len(times)} samples in {(time.perf_counter() - start)*1000:.1f}ms, "
+          f"max error {np.abs(read - values[-len(read):]).max():.4f}")
+    print({k: v[:3] for k, v in store.downsample("soil", interval=60*60).items()})
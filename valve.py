@@ -1,7 +1,9 @@
 import gpiozero
 from gpiozero.pins.mock import MockFactory
 from datetime import datetime
-from time import sleep
+from time import sleep, monotonic
+
+import metrics
 
 
 class Valve:
@@ -31,6 +33,7 @@ class Valve:
                  mock_on_fail=True,
                  debug=False):
         self.debug = debug
+        self.opened = None # monotonic time the valve was turned on
         try:
             self.relay1 = gpiozero.DigitalOutputDevice(relay1_pin, active_high=active_high)
             self.relay2 = gpiozero.DigitalOutputDevice(relay2_pin, active_high=active_high)
@@ -65,12 +68,19 @@ class Valve:
         if self.debug: print(f"{datetime.now()} | Turning the valve off")
         self.relay1.off()
         self.relay2.off()
+        if self.opened is not None:
+            metrics.increment("valve_on_seconds_total", monotonic() - self.opened)
+            self.opened = None
+        metrics.set_gauge("valve_on", 0)
 
 
     def __on(self):
         if self.debug: print(f"{datetime.now()} | Turning the valve on")
         self.relay1.on()
         self.relay2.on()
+        if self.opened is None:
+            self.opened = monotonic()
+        metrics.set_gauge("valve_on", 1)
 
     def timer(self, duration):
         """Convenience function for readability"""
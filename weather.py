@@ -1,7 +1,9 @@
-import requests
 import re
-from datetime import datetime, timedelta, timezone
+from datetime import datetime, timezone
+from functools import lru_cache
 from pprint import pprint 
+import numpy as np
+from http_cache import HttpCache
 
 class NationalWeatherService:
     """Summarize data from NWS API
@@ -20,6 +22,9 @@ class NationalWeatherService:
         forecast_hours - Period of future time over which to summarize conditions.
                          For twice-daily watering, 12 hours is reasonable.
         api_server - Defaults to primary NWS server.
+        cache_dir - Directory for cached API responses. The points lookup is
+                    cached permanently; forecasts are revalidated when they
+                    expire.
     
     NWS API documentation can be located at: 
     https://www.weather.gov/documentation/services-web-api
@@ -30,6 +35,7 @@ class NationalWeatherService:
                        user_agent="myweatherapp.com, contact@myweatherapp.com",
                        forecast_hours=12,
                        api_server="https://api.weather.gov",
+                       cache_dir=".nws_cache",
                        debug=False):
 
         self.latitude = latitude
@@ -40,97 +46,170 @@ class NationalWeatherService:
 
         # The NWS requests a unique string in the 'User-Agent' header
         self.headers = {'User-Agent': user_agent}
+        self.cache = HttpCache(cache_dir, headers=self.headers, debug=debug)
 
 
-        # Get API endpoint for my longitude and latitude
-# TODO: this sometimes returns a response such as below. Maybe add a retry on
-# error or on 'status':500
-#{
-#    'correlationId': '494c5834',
-#    'title': 'Unexpected Problem', 
-#    'type': 'https://api.weather.gov/problems/UnexpectedProblem', 
-#    'status': 500, 
-#    'detail': 'An unexpected problem has occurred.', 
-#    'instance': 'https://api.weather.gov/requests/494c5834'
-#}
-        r = requests.get(self.api_server + \
-                         "/points/"  + \
-                         str(self.latitude) + "," + \
-                         str(self.longitude), headers=self.headers).json()
-        self.api = r['properties']['forecastGridData']
-
-
-    def fetch(self):
-        # Get the forecast for my grid
-        r = requests.get(self.api, headers=self.headers).json()
-        
-        
-        # The following properties are useful
-        properties = ["probabilityOfPrecipitation",
-                      "quantitativePrecipitation", 
-                      "relativeHumidity",
-                      "skyCover",
-                      "temperature",
-                      "windSpeed",
-                      "windGust"]
-        
-        
-        # Parse the "validTime" string into "time" and "duration" properties
-        # to make this easier to deal with than the native format is.
-        # Example "validTime" in the response: "2021-05-27T04:00:00+00:00/PT1H"
-        # which is the date followed by the string "/PT1H" indicating 1 hour duration.
+        self.api = grid_url(self.cache, self.api_server, self.latitude, self.longitude)
+
+
+    def fetch(self, deadline=None):
+        """Return the forecast summary over the next forecast_hours
+
+        deadline:  time.monotonic() value by which to give up
+        """
+        return self.fetch_windows([self.forecast_hours], deadline)[self.forecast_hours]
+
+
+    def fetch_windows(self, windows=(6, 12, 24, 72), deadline=None):
+        """Return forecast summaries for several windows, keyed by hours"""
+        summaries = self.forecast(deadline).summarize(windows)
+        if self.debug: pprint(summaries)
+        return summaries
+
+
+    def forecast(self, deadline=None):
+        """Get the forecast for my grid as a Forecast"""
+        return Forecast(self.grid(deadline))
+
+
+    def grid(self, deadline=None):
+        """Get the gridpoint forecast for my grid as the JSON response"""
+        return self.cache.get(self.api, deadline=deadline)
+
+
+    def last_forecast(self):
+        """Return the forecast summary from the last forecast downloaded,
+        however old, for when the NWS can't be reached. Raises LookupError if
+        there is none.
+        """
+        grid = self.cache.last(self.api)
+        if grid is None:
+            raise LookupError("No forecast has been downloaded yet")
+        return Forecast(grid).summarize([self.forecast_hours])[self.forecast_hours]
+
+
+def grid_url(cache, api_server, latitude, longitude):
+    """Return the forecastGridData URL of the NWS grid cell of a location
+
+    Get API endpoint for my longitude and latitude. (The NWS sometimes
+    answers with status 500 "Unexpected Problem"; the cache retries.)
+    The grid for a location practically never changes, so it is only
+    looked up once.
+    """
+    r = cache.get(api_server + \
+                  "/points/"  + \
+                  str(latitude) + "," + \
+                  str(longitude), permanent=True)
+    return r['properties']['forecastGridData']
+
+
+# The following properties are useful. Each is summarized either as an
+# average weighted by duration, or as a total (ie, for precipitation).
+SUMMARY = {"probabilityOfPrecipitation": ("ave_probability_of_precipitation", "average"),
+           "quantitativePrecipitation":  ("total_precipitation", "total"),
+           "relativeHumidity":           ("ave_relative_humidity", "average"),
+           "skyCover":                   ("ave_sky_cover", "average"),
+           "temperature":                ("ave_temperature", "average"),
+           "windSpeed":                  ("ave_wind_speed", "average"),
+           "windGust":                   ("ave_wind_gust", "average")}
+
+# ISO 8601 duration, e.g. "PT1H" or "P1DT6H"
+DURATION = re.compile(r"P(?:(\d+)W)?(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?$")
+DURATION_SECONDS = (7*24*60*60, 24*60*60, 60*60, 60, 1)
+
+
+@lru_cache(maxsize=None)
+def parse_duration(duration):
+    """Return the number of seconds in an ISO 8601 duration string"""
+    m = DURATION.match(duration)
+    if m is None:
+        raise ValueError(f"Unsupported duration {duration!r}")
+    return sum(int(n) * s for n, s in zip(m.groups(), DURATION_SECONDS) if n)
+
+
+class Forecast:
+    """Columnar forecast for one NWS gridpoint
+
+    The gridpoint response is parsed once. For each property, start times
+    (seconds since the epoch), durations (seconds) and values are kept in
+    parallel NumPy arrays.
+
+    Example "validTime" in the response: "2021-05-27T04:00:00+00:00/PT1H"
+    which is the date followed by the string "/PT1H" indicating 1 hour duration.
+    """
+
+    def __init__(self, grid, properties=SUMMARY):
+        # time the NWS made this forecast
+        self.updated = grid['properties'].get('updateTime')
+        self.columns = {}
         for p in properties:
-            for v in r['properties'][p]['values']:
-                fields = re.split("/", v['validTime'])
-                v['time'] = datetime.strptime(fields[0], "%Y-%m-%dT%H:%M:%S%z")
-                v['duration'] = int(re.search("[0-9]+", fields[1]).group())
-        
-        
-        # Function to sum the value and duration over upcoming period of time
-        # later, if you want the total (ie, for precipitation) just use the sum.
-        # or if you want the average you can divide accum_value/accum_duration
-        def accumulate_over_period(property, period):
-            accum_value = 0
-            accum_duration = 0
-            accum_value_times_duration = 0
-            for v in r['properties'][property]['values']:
-                # if the timestamp is between the present time and present+period
-                if datetime.now(timezone.utc) <= \
-                   v['time'] <= \
-                   datetime.now(timezone.utc) + timedelta(hours=period):
-                    accum_value += v['value']
-                    accum_duration += v['duration']
-                    accum_value_times_duration += v['value'] * v['duration']
-            return accum_value, accum_duration, accum_value_times_duration
-        
-        
-        # Summarize properties over FORECAST_HOURS
-        summary = {}
-        
-        v, d, vd = accumulate_over_period('probabilityOfPrecipitation', self.forecast_hours)
-        summary['ave_probability_of_precipitation'] = 0 if d==0 else round(vd/d, 2)
-        
-        v, d, vd = accumulate_over_period('quantitativePrecipitation', self.forecast_hours)
-        summary['total_precipitation'] = round(v, 2)
-        
-        v, d, vd = accumulate_over_period('relativeHumidity', self.forecast_hours)
-        summary['ave_relative_humidity'] = 0 if d==0 else round(vd/d, 2)
-        
-        v, d, vd = accumulate_over_period('skyCover', self.forecast_hours)
-        summary['ave_sky_cover'] = 0 if d==0 else round(vd/d, 2)
-        
-        v, d, vd = accumulate_over_period('temperature', self.forecast_hours)
-        summary['ave_temperature'] = 0 if d==0 else round(vd/d, 2)
-        
-        v, d, vd = accumulate_over_period('windSpeed', self.forecast_hours)
-        summary['ave_wind_speed'] = 0 if d==0 else round(vd/d, 2)
-        
-        v, d, vd = accumulate_over_period('windGust', self.forecast_hours)
-        summary['ave_wind_gust'] = 0 if d==0 else round(vd/d, 2)
-        
-        if self.debug: pprint(summary)
-    
-        return summary
+            values = grid['properties'][p]['values']
+            start = np.empty(len(values))
+            duration = np.empty(len(values))
+            value = np.empty(len(values))
+            for i, v in enumerate(values):
+                time, _, period = v['validTime'].partition('/')
+                start[i] = datetime.fromisoformat(time).timestamp()
+                duration[i] = parse_duration(period)
+                value[i] = np.nan if v['value'] is None else v['value']
+            self.columns[p] = (start, duration, value)
+
+
+    def summarize(self, windows, now=None):
+        """Summarize every property over each window of hours from now
+
+        A value counts towards a window if its start time is between now and
+        now plus the window. All windows of a property are computed at once.
+
+        windows:  Iterable of window lengths in hours
+        now:      datetime, defaults to the current time
+
+        Returns {hours: summary} with one summary dictionary per window.
+        """
+        windows = list(windows)
+        now = (now or datetime.now(timezone.utc)).timestamp()
+        end = now + np.array(windows, dtype=float) * 60 * 60
+
+        columns = self.summarize_windows(np.full(len(windows), now), end)
+        return {w: {key: round(float(values[i]), 2) for key, values in columns.items()}
+                for i, w in enumerate(windows)}
+
+
+    def summarize_windows(self, starts, ends):
+        """Summarize every property over many windows at once
+
+        starts, ends:  Arrays of window start and end times in seconds since
+                       the epoch
+
+        Returns {summary key: array} with one unrounded value per window.
+        """
+        starts = np.asarray(starts, dtype=float)[:, None]
+        ends = np.asarray(ends, dtype=float)[:, None]
+
+        summaries = {}
+        for p, (key, statistic) in SUMMARY.items():
+            start, duration, value = self.columns[p]
+            valid = ~np.isnan(value)
+            value = np.where(valid, value, 0)
+
+            # one row per window
+            mask = (start >= starts) & (start <= ends) & valid
+            if statistic == "total":
+                summaries[key] = mask @ value
+            else:
+                accum_duration = mask @ duration
+                weighted = mask @ (value * duration)
+                summaries[key] = np.divide(weighted, accum_duration,
+                                           out=np.zeros(len(weighted)),
+                                           where=accum_duration != 0)
+
+        return summaries
+
+
+    def end(self):
+        """Return the end of the forecast in seconds since the epoch"""
+        return min(float(np.max(start + duration, initial=0))
+                   for start, duration, _ in self.columns.values())
 
 
 if __name__ == "__main__":
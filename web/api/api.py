@@ -1,9 +1,14 @@
+import os
 import sys
+import math
 import time
+import gzip
+import json
+import hashlib
 from flask import Flask, request
 from dotenv import dotenv_values
 import random
-from collections import OrderedDict
+from datetime import datetime
 
 # Location of project root
 PROJECT_ROOT = "../.."
@@ -12,9 +17,15 @@ PROJECT_ROOT = "../.."
 sys.path.append(PROJECT_ROOT)
 
 # remaining imports now that we can reach our project modules
-from soil_moisture_sensor import SoilMoistureSensor
+from soil_moisture_sensor import SoilMoistureSensor, CachedSensor
 from log import Log
-from valve import Valve
+from actuator import actuated_valve
+from hardware import RemoteSensor, RemoteValve
+from stream import Broadcaster
+import metrics
+from downsample import lttb
+from telemetry import TelemetryStore
+import planner
 
 
 # load .env configuration from project root
@@ -26,9 +37,40 @@ app = Flask(__name__, static_folder="../build", static_url_path="/")
 
 
 # define Ogarden objects
-sensor = SoilMoistureSensor(debug=15000)
+# With HARDWARE_SOCKET, the valve and sensor are owned by the hardware broker
+# (hardware.py), so any number of workers can share them
+if config.get('HARDWARE_SOCKET'):
+    sensor = RemoteSensor(config['HARDWARE_SOCKET'])
+    valve = RemoteValve(config['HARDWARE_SOCKET'])
+else:
+    sensor = SoilMoistureSensor(debug=15000)
+    # the valve closes by itself after at most VALVE_MAX_DURATION seconds, and
+    # is closed if the server restarts while it is open. The deadlines are
+    # kept apart from the application's (VALVE_DEADLINES with ".web" added),
+    # and only one worker can own them: use the broker for more workers.
+    root, ext = os.path.splitext(config.get('VALVE_DEADLINES', 'valve_deadlines.json'))
+    valve = actuated_valve(PROJECT_ROOT + "/" + root + ".web" + ext,
+                           float(config.get('VALVE_MAX_DURATION', 60*60)))
+
+# Sensor readings are shared between requests for up to SENSOR_MAX_AGE seconds
+sensor = CachedSensor(sensor, max_age=float(config.get('SENSOR_MAX_AGE', 5)))
 log = Log(PROJECT_ROOT + "/" + config['LOG'])
-valve = Valve()
+
+# Sensor samples recorded by the daemon's sampler, if it keeps them
+telemetry = TelemetryStore(PROJECT_ROOT + "/" + config['TELEMETRY_DIR'], readonly=True) \
+            if config.get('TELEMETRY_DIR') else None
+
+
+def poll():
+    """Current state pushed to /api/stream clients"""
+    reading = sensor.measure()
+    reading.pop('age')
+    newest = log.tail(1)
+    return {'sensor': reading,
+            'valve': {'isValveOn': valve.status()},
+            'log': newest[0] if newest else None}
+
+broadcaster = Broadcaster(poll, interval=float(config.get('STREAM_INTERVAL', 1)))
 
 
 # define routes (API endpoints)
@@ -37,6 +79,26 @@ def index():
     return app.send_static_file('index.html')
 
 
+@app.route('/metrics')
+def api_metrics():
+    """Metrics of the web API, of the latest watering session and of the
+    hardware broker (if there is one), in the Prometheus text exposition
+    format
+    """
+    text = metrics.render(prefix="ogarden_web_")
+    try:
+        with open(PROJECT_ROOT + "/" + config.get('METRICS_FILE', 'metrics.prom')) as f:
+            text += f.read()
+    except OSError:
+        pass
+    if config.get('HARDWARE_SOCKET'):
+        try:
+            text += valve.metrics()
+        except Exception:
+            metrics.increment("errors_total", source="hardware_metrics")
+    return text, 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+
 @app.route('/api/time')
 def api_time():
     return {'time': time.time()}
@@ -44,7 +106,21 @@ def api_time():
 
 @app.route('/api/sensor')
 def api_sensor():
-    return sensor.measure()
+    """Returns a recent sensor reading and its age in seconds. Use fresh=1
+    to force a new reading (e.g. http://localhost/api/sensor?fresh=1)
+    """
+    return sensor.measure(fresh=request.args.get('fresh') == '1')
+
+
+@app.route('/api/stream')
+def api_stream():
+    """Server-sent events with the latest "sensor", "valve" and "log" state,
+    sent when it changes
+    """
+    return app.response_class(broadcaster.stream(),
+                              mimetype='text/event-stream',
+                              headers={'Cache-Control': 'no-cache',
+                                       'X-Accel-Buffering': 'no'})
 
 
 @app.route('/api/random')
@@ -55,28 +131,190 @@ def api_random():
 
 @app.route('/api/log')
 def api_log():
-    """Returns the log as a JSON object, limited by limit parameter
-    (e.g. http://localhost/api/log?limit=50)
+    """Returns log records as a JSON object, newest limit records first in
+    time order (e.g. http://localhost/api/log?limit=50)
+
+    Optional parameters:
+        since   ISO 8601 time, only records at or after it
+        until   ISO 8601 time, only records before it
+        cursor  next_cursor from a previous response, to fetch older records
+
+    The response carries an ETag derived from the log's contents, so a
+    client sending it back in If-None-Match gets a 304 until a session is
+    logged or old records are removed.
     """
-    num = int(request.args.get('limit') or 60)
+    try:
+        num = int(request.args.get('limit') or 60)
+    except ValueError:
+        num = 0
+    if num < 1:
+        return {'error': 'limit must be a positive integer'}, 400
+    since = request.args.get('since')
+    until = request.args.get('until')
+
+    # the cursor is the timestamp and id of the oldest record already sent
+    cursor = request.args.get('cursor')
+    before = None
+    if cursor is not None:
+        timestamp, _, id = cursor.rpartition(',')
+        if not timestamp or not id.isdigit():
+            return {'error': 'invalid cursor'}, 400
+        before = (timestamp, int(id))
+
+    etag = hashlib.sha1(f"{log.version()}|{request.query_string}".encode()).hexdigest()
+    if etag in request.if_none_match:
+        return '', 304, {'ETag': f'"{etag}"'}
+
+    records, position = log.page(since=since, until=until, before=before, limit=num)
+    next_cursor = f"{position[0]},{position[1]}" if position else None
+
+    response = compress(app.response_class(
+        json.dumps({'records': records, 'next_cursor': next_cursor}),
+        mimetype='application/json'))
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+@app.route('/api/log/series')
+def api_log_series():
+    """Returns log fields as parallel arrays (columns) for charting
+    (e.g. http://localhost/api/log/series?fields=water_amount,ave_temperature&points=200)
+
+    Parameters:
+        fields  Comma separated field names
+        since   ISO 8601 time (or date, for rollups) of the start of the series
+        until   ISO 8601 time (or date, for rollups) of the end of the series
+        points  Downsample the series to at most this many points, keeping
+                the shape of the line of the first numeric field
+        rollup  "day" or "week" to return the stored rollups (count, sum,
+                mean, min and max of each field) instead of log entries
+        history "1" to include archived log entries
+    """
+    fields = [f for f in (request.args.get('fields') or '').split(',') if f]
+    since = request.args.get('since')
+    until = request.args.get('until')
+    points = request.args.get('points')
+    rollup = request.args.get('rollup')
+    history = request.args.get('history') == '1'
+
+    if not all(f.isidentifier() for f in fields):
+        return {'error': 'fields must be comma separated field names'}, 400
+    if points is not None and not (points.isdigit() and int(points) >= 3):
+        return {'error': 'points must be an integer of at least 3'}, 400
+
+    etag = hashlib.sha1(f"{log.version()}|{request.query_string}".encode()).hexdigest()
+    if etag in request.if_none_match:
+        return '', 304, {'ETag': f'"{etag}"'}
+
+    if rollup:
+        if rollup not in ('day', 'week'):
+            return {'error': 'rollup must be day or week'}, 400
+        columns = log.rollups(rollup, fields, since=since, until=until)
+    else:
+        if history:
+            columns = log.history(fields, since=since, until=until)
+        else:
+            columns = log.series(fields, since=since, until=until)
+        if points and fields:
+            # e.g. degraded (a list) or a note can't be drawn as a line
+            numeric = [f for f in fields if all(
+                v is None or (isinstance(v, (int, float)) and not isinstance(v, bool))
+                for v in columns[f])]
+            if not numeric:
+                return {'error': 'points needs at least one numeric field'}, 400
+            x = [datetime.fromisoformat(t).timestamp() for t in columns['isodatetime']]
+            y = [float('nan') if v is None else v for v in columns[numeric[0]]]
+            keep = lttb(x, y, int(points))
+            columns = {k: [v[i] for i in keep] for k, v in columns.items()}
+
+    response = compress(app.response_class(json.dumps(columns),
+                                           mimetype='application/json'))
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+@app.route('/api/plan')
+def api_plan():
+    """Returns the planned sessions from now to the end of the forecast,
+    with their forecast conditions and projected water amount and valve
+    duration (see planner.py)
+    """
+    plan = planner.load(PROJECT_ROOT + "/" + config.get('PLAN_FILE', 'plan.json'))
+    if plan is None:
+        return {'error': 'no plan has been made yet'}, 404
+
+    # drop sessions which have passed
+    now = datetime.now().isoformat()
+    plan['sessions'] = [s for s in plan['sessions'] if s['time'] >= now]
+
+    etag = hashlib.sha1(f"{plan['checked']}|{len(plan['sessions'])}".encode()).hexdigest()
+    if etag in request.if_none_match:
+        return '', 304, {'ETag': f'"{etag}"'}
+    response = compress(app.response_class(json.dumps(plan), mimetype='application/json'))
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+@app.route('/api/telemetry')
+def api_telemetry():
+    """Returns per-interval statistics of recorded sensor samples as columns
+    (e.g. http://localhost/api/telemetry?sensor=soil&since=1625000000&interval=60)
+
+    Parameters:
+        sensor    Sensor name (default soil)
+        since     Start time in seconds since the epoch
+        until     End time in seconds since the epoch
+        interval  Seconds per interval (default 60)
+    """
+    if telemetry is None:
+        return {'error': 'TELEMETRY_DIR is not configured'}, 404
+    sensor_name = request.args.get('sensor', 'soil')
+    if sensor_name not in telemetry.sensors():
+        return {'error': f'no telemetry for {sensor_name}'}, 404
+
+    since = request.args.get('since', type=float)
+    until = request.args.get('until', type=float)
+    interval = request.args.get('interval', 60, type=float)
+    if interval <= 0:
+        return {'error': 'interval must be positive'}, 400
+
+    columns = telemetry.downsample(sensor_name, since, until, interval)
+    response = compress(app.response_class(json.dumps(columns),
+                                           mimetype='application/json'))
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
 
-    # the log returns a list of JSON objects, but must be a single JSON object 
-    lst = log.tail(num)
 
-    # create OrderedDict to preserve time order of elements
-    # since each log entry must have a top-level key in the wrapper JSON object
-    # that will be the isodatetime value, which also remains inside the object
-    od = OrderedDict()
-    for d in lst:
-        od[d['isodatetime']] = d
+def compress(response, min_size=1024):
+    """Gzip the response body if it is large and the client accepts gzip"""
+    if 'gzip' not in request.accept_encodings or \
+       len(response.get_data()) < min_size:
+        return response
 
-    return od 
+    response.set_data(gzip.compress(response.get_data()))
+    response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return response
 
 
 @app.route('/api/valve/on')
 def api_valve_on():
-    valve.on()
-    return {'isValveOn': True}
+    """Turn the valve on for ?duration= seconds, by default the longest allowed
+    (VALVE_MAX_DURATION). Returns at once with the duration applied, which
+    is at most VALVE_MAX_DURATION."""
+    duration = request.args.get('duration')
+    if duration:
+        try:
+            duration = float(duration)
+        except ValueError:
+            duration = math.nan
+        if not (math.isfinite(duration) and duration > 0):
+            return {'error': 'duration must be a positive number of seconds'}, 400
+    duration = valve.on(duration or None)
+    return {'isValveOn': True, 'duration': duration, 'remaining': valve.remaining()}
 
 
 @app.route('/api/valve/off')
@@ -87,5 +325,5 @@ def api_valve_off():
 
 @app.route('/api/valve')
 def api_valve_status():
-    return {'isValveOn': True} if valve.status() else {'isValveOn': False}
+    return {'isValveOn': bool(valve.status()), 'remaining': valve.remaining()}
 
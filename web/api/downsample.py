@@ -0,0 +1,56 @@
+"""Downsampling of chart series
+
+Largest-Triangle-Three-Buckets (LTTB) keeps the points which preserve the
+visual shape of a line chart, so a long series can be sent to the browser as a
+few hundred points.
+
+Sveinn Steinarsson, "Downsampling Time Series for Visual Representation"
+https://skemman.is/handle/1946/15343
+"""
+
+import numpy as np
+
+
+def lttb(x, y, n):
+    """Return the indices of n points of (x, y) chosen by LTTB
+
+    x, y:  Sequences of the same length, x increasing. Missing (NaN) y values
+           are treated as the mean of y.
+    n:     Number of points to keep (at least 3)
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if n >= len(x) or n < 3:
+        return np.arange(len(x))
+
+    y = np.where(np.isnan(y), np.nanmean(y) if np.isfinite(y).any() else 0, y)
+
+    # The first and last points are always kept. The rest are split into
+    # n - 2 buckets, and one point is kept from each.
+    edges = np.linspace(1, len(x) - 1, n - 1).astype(int)
+    indices = np.empty(n, dtype=int)
+    indices[0], indices[-1] = 0, len(x) - 1
+
+    for i in range(n - 2):
+        start, end = edges[i], edges[i + 1]
+
+        # average of the next bucket (or the last point)
+        if i + 2 < len(edges):
+            nx = x[end:edges[i + 2]].mean()
+            ny = y[end:edges[i + 2]].mean()
+        else:
+            nx, ny = x[-1], y[-1]
+
+        # keep the point making the largest triangle with the previous kept
+        # point and the next bucket's average
+        px, py = x[indices[i]], y[indices[i]]
+        area = np.abs((px - nx) * (y[start:end] - py) - (px - x[start:end]) * (ny - py))
+        indices[i + 1] = start + int(np.argmax(area))
+
+    return indices
+
+
+if __name__ == "__main__":
+    x = np.arange(1000)
+    y = np.sin(x / 50) + np.random.normal(0, 0.1, len(x))
+    print(lttb(x, y, 20))
@@ -0,0 +1,112 @@
+"""Server-sent events stream of live Ogarden state
+
+One producer thread polls the state (sensor reading, valve, newest log record)
+and publishes only what changed. Every connected client gets the changes from
+that one producer, so more viewers don't mean more sensor reads or database
+queries. The producer only runs while at least one client is connected.
+"""
+
+import json
+import queue
+import threading
+import time
+
+
+class Broadcaster:
+    """Fans out changes of polled state to every subscribed client
+
+    poll:       Function returning a dictionary of event name to current value
+    interval:   Seconds between polls
+    heartbeat:  Seconds between keep-alive comments when nothing changes
+    """
+
+    def __init__(self, poll, interval=1.0, heartbeat=15):
+        self.poll = poll
+        self.interval = interval
+        self.heartbeat = heartbeat
+        self.lock = threading.Lock()
+        self.clients = set()
+        self.state = {}
+        self.thread = None
+
+
+    def subscribe(self):
+        """Returns a queue which receives (event, data) tuples"""
+        q = queue.Queue(maxsize=100)
+        with self.lock:
+            # new clients start with the latest known state
+            for event, data in self.state.items():
+                q.put((event, data))
+            self.clients.add(q)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+        return q
+
+
+    def unsubscribe(self, q):
+        with self.lock:
+            self.clients.discard(q)
+
+
+    def publish(self, event, data):
+        with self.lock:
+            self.state[event] = data
+            for q in list(self.clients):
+                try:
+                    q.put_nowait((event, data))
+                except queue.Full:
+                    # a client which stopped reading is dropped. Its stream
+                    # ends, so the browser reconnects and starts over from the
+                    # latest state.
+                    self.clients.discard(q)
+                    self.close(q)
+
+
+    def close(self, q):
+        """Replace the events waiting in q with None, which ends its stream"""
+        try:
+            while True:
+                q.get_nowait()
+        except queue.Empty:
+            pass
+        q.put_nowait(None)
+
+
+    def run(self):
+        while True:
+            with self.lock:
+                if not self.clients:
+                    self.thread = None
+                    return
+            try:
+                current = self.poll()
+            except Exception as e:
+                current = {"error": {"error": str(e)}}
+            else:
+                # an error is only news until polling works again
+                with self.lock:
+                    self.state.pop("error", None)
+            for event, data in current.items():
+                if self.state.get(event) != data:
+                    self.publish(event, data)
+            time.sleep(self.interval)
+
+
+    def stream(self):
+        """Generator of server-sent events for one client"""
+        q = self.subscribe()
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                try:
+                    item = q.get(timeout=self.heartbeat)
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+                    continue
+                if item is None:
+                    return
+                event, data = item
+                yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+        finally:
+            self.unsubscribe(q)
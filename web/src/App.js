@@ -5,6 +5,7 @@ import Container from 'react-bootstrap/Container';
 import Navigation from './components/Navigation.js';
 import ChartCard from './components/ChartCard.js';
 import WeatherCard from './components/WeatherCard.js';
+import useEventStream from './hooks/useEventStream.js';
 
 
 export default function App() {
@@ -12,9 +13,15 @@ export default function App() {
 
   useEffect(() => {
     fetch('/api/log').then(res => res.json()).then(data => {
-      setLog(Object.values(data));
+      setLog(data.records);
     });
   }, []);
+
+  // Append sessions as they are logged
+  useEventStream('log', record => {
+    setLog(log => (record === null || log.some(l => l.isodatetime === record.isodatetime))
+      ? log : [...log, record]);
+  });
   
 
   return (
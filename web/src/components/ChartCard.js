@@ -1,36 +1,30 @@
-import React from 'react';
+import React, { useState, useEffect } from 'react';
 import { Line } from 'react-chartjs-2';
 
 import Card from 'react-bootstrap/Card';
 import { cToF } from '../logic/helpers.js';
 
 
-export default function ChartCard({log}) {
-
-  const temperature = [];
-  log.map(l => temperature.push(cToF(l.ave_temperature)));
+// Most points to plot. The server downsamples longer histories.
+const POINTS = 200;
 
-  const water = [];
-  log.map(l => water.push(l.water_amount));
 
-  // Convert the isodatetime's into Date objects
-  const dates = [];
-  log.map(l => dates.push(new Date(l.isodatetime)));
-
-  // Convert the date objects into num days before now
-  // (date subtraction returns milliseconds of time difference
-  const days_ago = [];
-  dates.map(d => days_ago.push((Date.now()-d)/1000/60/60/24));
+export default function ChartCard({log}) {
+  const [series, setSeries] = useState({isodatetime: [], ave_temperature: [], water_amount: []});
 
-  // fix precision to three 
-  const days_ago_fixed = [];
-  days_ago.map(d => days_ago_fixed.push(Number.parseFloat(d).toPrecision(3)));
+  // Fetch the chart columns again whenever a session is logged
+  useEffect(() => {
+    fetch(`/api/log/series?fields=ave_temperature,water_amount&points=${POINTS}`)
+      .then(res => res.json()).then(data => setSeries(data));
+  }, [log.length]);
 
+  const temperature = series.ave_temperature.map(cToF);
+  const water = series.water_amount;
 
-  // Now we have our datasets to plot
-  console.log(temperature);
-  console.log(water);
-  console.log(days_ago_fixed);
+  // Convert the isodatetime's into num days before now, with precision of three
+  // (date subtraction returns milliseconds of time difference)
+  const days_ago_fixed = series.isodatetime.map(t =>
+    Number.parseFloat((Date.now() - new Date(t))/1000/60/60/24).toPrecision(3));
 
 
   const data = {
@@ -1,6 +1,6 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState } from 'react';
 
-import useInterval from '../hooks/useInterval.js';
+import useEventStream from '../hooks/useEventStream.js';
 
 import logo from './logo.svg';
 
@@ -11,25 +11,10 @@ import Card from 'react-bootstrap/Card';
 export default function Sensor() {
   const [sensorValue, setSensorValue] = useState(null);
 
-  function fetchRandom() {
-    fetch('/api/random').then(res => res.json()).then(data => {
-      setSensorValue(data.random);
-      console.log(data.random);
-    });
-  }
-
-
-  useInterval(() => {
-    fetchRandom();
-  }, 1000);
-
-  useEffect(() => {
-    fetchRandom();
-    
-    //fetch('/api/sensor').then(res => res.json()).then(data => {
-    //  setSensorValue(data.sensor_value);
-    //});
-  }, []);
+  // The server pushes a new value whenever the reading changes
+  useEventStream('sensor', data => {
+    setSensorValue(data.sensor_value);
+  });
 
   return (
     <div style={{ 'marginTop': '0.7rem' }}>
@@ -0,0 +1,57 @@
+// Custom React Hook which listens to server-sent events from /api/stream
+//
+// Usage example:
+//
+//  useEventStream('sensor', data => setSensorValue(data.sensor_value));
+//
+// Events are "sensor", "valve" and "log". Each is sent when it changes, and
+// once when the stream connects.
+//
+// Every component on the page shares one EventSource per url, since each open
+// stream holds one of the server's threads.
+
+
+
+import { useEffect, useRef } from 'react';
+
+// url -> {source, users}
+const streams = {};
+
+function openStream(url) {
+  if (!streams[url]) {
+    streams[url] = { source: new EventSource(url), users: 0 };
+  }
+  streams[url].users += 1;
+  return streams[url].source;
+}
+
+function closeStream(url) {
+  streams[url].users -= 1;
+  if (streams[url].users === 0) {
+    streams[url].source.close();
+    delete streams[url];
+  }
+}
+
+export default function useEventStream(event, callback, url = '/api/stream') {
+  const savedCallback = useRef();
+
+  // Remember the latest callback.
+  useEffect(() => {
+    savedCallback.current = callback;
+  }, [callback]);
+
+  // Listen on the shared stream. The browser reconnects automatically if it
+  // drops.
+  useEffect(() => {
+    const source = openStream(url);
+    function listener(e) {
+      savedCallback.current(JSON.parse(e.data));
+    }
+    source.addEventListener(event, listener);
+    return () => {
+      source.removeEventListener(event, listener);
+      closeStream(url);
+    };
+  }, [event, url]);
+}
@@ -0,0 +1,138 @@
+"""Water several garden zones at once without exceeding the water supply
+
+Each zone has its own valve and irrigation model. Zones run concurrently as
+long as the sum of their flow rates stays within the supply limit; the rest
+wait in a queue and start as soon as enough flow is free. The longest zones
+are started first, which keeps the total watering time short.
+
+Usage:
+    controller = ZoneController([Zone("beds", Valve(17, 27), beds_model),
+                                 Zone("lawn", Valve(22, 23), lawn_model)],
+                                supply_liters_per_second=0.1)
+    asyncio.run(controller.run({"beds": 3.5, "lawn": 2.0}))
+"""
+
+import asyncio
+import time
+from datetime import datetime
+
+
+class Zone:
+    """One independently valved zone of the garden
+
+    name:        Name of the zone
+    valve:       Valve which waters the zone
+    irrigation:  IrrigationModel of the zone's emitters
+    """
+
+    def __init__(self, name, valve, irrigation):
+        self.name = name
+        self.valve = valve
+        self.irrigation = irrigation
+        self.state = "idle"
+        self.duration = 0
+        self.started = None
+
+
+    @property
+    def flow(self):
+        return self.irrigation.flow_rate_liters_per_second
+
+
+class ZoneController:
+    """Non-blocking controller for several zones sharing one water supply
+
+    zones:                     List of Zone
+    supply_liters_per_second:  Flow limit of the water supply
+    progress:                  Optional function called with a zone whenever
+                               its state changes
+    debug:                     Outputs debugging messages
+    """
+
+    def __init__(self, zones, supply_liters_per_second, progress=None, debug=False):
+        self.zones = {z.name: z for z in zones}
+        self.supply = supply_liters_per_second
+        self.progress = progress
+        self.debug = debug
+
+
+    async def run(self, water):
+        """Water each zone with the given depth of water (mm)
+
+        water:  Dictionary of zone name to millimeters of water
+
+        Returns a dictionary of zone name to valve duration in seconds.
+        """
+        queue = []
+        for name, mm in water.items():
+            zone = self.zones[name]
+            zone.duration = zone.irrigation.millimeters_to_seconds(mm)
+            if zone.duration > 0:
+                self.set_state(zone, "queued")
+                queue.append(zone)
+
+        # longest zones first
+        queue.sort(key=lambda z: z.duration, reverse=True)
+
+        running = {}  # task -> zone
+        while queue or running:
+            flow = sum(z.flow for z in running.values())
+            for zone in list(queue):
+                # a zone larger than the whole supply runs on its own
+                if flow + zone.flow <= self.supply or not running:
+                    queue.remove(zone)
+                    running[asyncio.ensure_future(self.water(zone))] = zone
+                    flow += zone.flow
+
+            done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                del running[task]
+                task.result()
+
+        return {z.name: z.duration for z in self.zones.values() if z.name in water}
+
+
+    async def water(self, zone):
+        """Open the zone's valve for its duration without blocking"""
+        zone.started = time.monotonic()
+        self.set_state(zone, "running")
+        zone.valve.on()
+        try:
+            await asyncio.sleep(zone.duration)
+        finally:
+            zone.valve.off()
+            self.set_state(zone, "done")
+
+
+    def set_state(self, zone, state):
+        zone.state = state
+        if self.debug: print(f"{datetime.now()} | {zone.name} {state}")
+        if self.progress: self.progress(zone)
+
+
+    def status(self):
+        """Returns the state, duration and remaining seconds of every zone"""
+        now = time.monotonic()
+        status = {}
+        for z in self.zones.values():
+            if z.state == "running":
+                remaining = max(0, z.started + z.duration - now)
+            elif z.state == "queued":
+                remaining = z.duration
+            else:
+                remaining = 0
+            status[z.name] = {"state": z.state,
+                              "duration": z.duration,
+                              "remaining": round(remaining, 1)}
+        return status
+
+
+if __name__ == "__main__":
+    from irrigation_model import IrrigationModel
+    from valve import Valve
+
+    # Three zones of 0.04 L/s each on a supply of 0.1 L/s: two run at once
+    model = IrrigationModel(liters=0.04, seconds=1, area_square_meters=0.02)
+    zones = [Zone(f"zone{i}", Valve(2*i + 2, 2*i + 3), model) for i in range(3)]
+    controller = ZoneController(zones, supply_liters_per_second=0.1, debug=True)
+    print(asyncio.run(controller.run({"zone0": 2, "zone1": 1, "zone2": 1})))